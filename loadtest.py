@@ -0,0 +1,281 @@
+"""Нагрузочный прогон бота целиком, без сети.
+
+Гоняет webhook_app.app через httpx.ASGITransport синтетическими апдейтами от множества
+пользователей. DeepSeek подменяется локальным HTTP-сервером (uvicorn в отдельном потоке,
+с настраиваемой задержкой, обычный или потоковый ответ), исходящие вызовы Bot API —
+фейковой сессией aiogram. В конце печатает пропускную способность, p50/p95/p99 и рост БД.
+
+Каждый пользователь пишет следующее сообщение только после ответа на предыдущее,
+поэтому задержка — это время от POST вебхука до финального текста ответа в чате.
+
+    python loadtest.py --users 200 --concurrency 50 --messages 5
+    python loadtest.py --stream --llm-latency-ms 800 --coalesce-ms 50
+
+Все настройки бота (LLM_MAX_CONCURRENCY, WEBHOOK_QUEUE_SIZE, DB_POOL_SIZE и т.д.) берутся
+из окружения, как и в проде.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import logging
+import argparse
+import tempfile
+import threading
+import itertools
+from datetime import datetime
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# маркеры ответа фейкового DeepSeek: по ним фейковый Telegram понимает, что ответ дописан
+REPLY_PREFIX = "«bench»"
+REPLY_SUFFIX = "∎"
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Sophia bot load test (offline)")
+    p.add_argument("--users", type=int, default=100, help="сколько разных пользователей")
+    p.add_argument("--messages", type=int, default=3, help="сообщений от каждого пользователя")
+    p.add_argument("--concurrency", type=int, default=50, help="сколько пользователей пишут одновременно")
+    p.add_argument("--think-ms", type=float, default=0, help="пауза пользователя между сообщениями")
+    p.add_argument("--llm-latency-ms", type=float, default=300, help="задержка DeepSeek до первого токена")
+    p.add_argument("--llm-token-ms", type=float, default=5, help="задержка между кусками ответа")
+    p.add_argument("--reply-words", type=int, default=40, help="длина ответа DeepSeek в словах")
+    p.add_argument("--stream", action="store_true", help="потоковые ответы (STREAM_REPLIES=1)")
+    p.add_argument("--tg-latency-ms", type=float, default=30, help="задержка каждого вызова Bot API")
+    p.add_argument("--coalesce-ms", type=int, default=None, help="переопределить COALESCE_WINDOW_MS")
+    p.add_argument("--timeout", type=float, default=120, help="сек ждать ответа на одно сообщение")
+    p.add_argument("--db", default=None, help="путь к БД (по умолчанию — новая во временной папке)")
+    p.add_argument("--log-level", default="WARNING")
+    return p.parse_args()
+
+
+# ========= FAKE DEEPSEEK =========
+def make_fake_deepseek(args) -> FastAPI:
+    fake = FastAPI()
+    words = [f"слово{i}" for i in range(max(1, args.reply_words))]
+    first_delay = args.llm_latency_ms / 1000
+    token_delay = args.llm_token_ms / 1000
+
+    def usage(body: dict) -> dict:
+        prompt = sum(len(m.get("content") or "") for m in body.get("messages", [])) // 4
+        return {"prompt_tokens": prompt, "completion_tokens": len(words),
+                "prompt_cache_hit_tokens": 0, "prompt_cache_miss_tokens": prompt}
+
+    @fake.get("/models")
+    async def models():
+        return {"object": "list", "data": [{"id": "deepseek-chat", "object": "model"}]}
+
+    @fake.post("/chat/completions")
+    async def completions(request: Request):
+        body = await request.json()
+        chunks = [REPLY_PREFIX] + [f" {w}" for w in words] + [f" {REPLY_SUFFIX}"]
+        if not body.get("stream"):
+            await asyncio.sleep(first_delay + token_delay * len(chunks))
+            return JSONResponse({
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(chunks)},
+                             "finish_reason": "stop"}],
+                "usage": usage(body),
+            })
+
+        async def events():
+            await asyncio.sleep(first_delay)
+            for chunk in chunks:
+                yield "data: " + json.dumps({"choices": [{"index": 0, "delta": {"content": chunk}}]}) + "\n\n"
+                await asyncio.sleep(token_delay)
+            yield "data: " + json.dumps({"choices": [], "usage": usage(body)}) + "\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return fake
+
+
+def serve_in_thread(app: FastAPI) -> tuple[str, uvicorn.Server]:
+    """Поднимает app на свободном порту в отдельном потоке (свой event loop, не мешает боту)."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    server = uvicorn.Server(uvicorn.Config(app, log_level="warning", lifespan="off", loop="asyncio"))
+    threading.Thread(target=server.run, kwargs={"sockets": [sock]}, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    host, port = sock.getsockname()
+    return f"http://{host}:{port}", server
+
+
+# ========= FAKE TELEGRAM =========
+def make_fake_session(tg_latency: float):
+    from aiogram.client.session.base import BaseSession
+    from aiogram.methods import EditMessageText, GetMe, SendMessage
+    from aiogram.types import Chat, Message, User
+
+    class FakeTelegramSession(BaseSession):
+        """Отвечает на вызовы Bot API правдоподобными объектами и сигналит о финальных ответах."""
+
+        def __init__(self):
+            super().__init__()
+            self.calls: dict[str, int] = {}
+            self.waiters: dict[int, asyncio.Future] = {}
+            self._message_ids = itertools.count(1)
+
+        def _finish(self, chat_id: int, ok: bool):
+            fut = self.waiters.pop(chat_id, None)
+            if fut is not None and not fut.done():
+                fut.set_result(ok)
+
+        async def make_request(self, bot, method, timeout=None):
+            name = type(method).__name__
+            self.calls[name] = self.calls.get(name, 0) + 1
+            await asyncio.sleep(tg_latency)
+            if isinstance(method, GetMe):
+                return User(id=1, is_bot=True, first_name="Sophia", username="sophia_bench_bot")
+            if isinstance(method, (SendMessage, EditMessageText)):
+                text = method.text or ""
+                if text.endswith(REPLY_SUFFIX):
+                    self._finish(method.chat_id, True)
+                elif isinstance(method, SendMessage) and not text.startswith(REPLY_PREFIX):
+                    # ошибка модели, пэйвол и т.п. — ответа от DeepSeek не будет
+                    self._finish(method.chat_id, False)
+                if isinstance(method, SendMessage):
+                    return Message(message_id=next(self._message_ids), date=datetime.now(),
+                                   chat=Chat(id=method.chat_id, type="private"), text=text)
+                return Message(message_id=method.message_id or 0, date=datetime.now(),
+                               chat=Chat(id=method.chat_id, type="private"), text=text)
+            return True
+
+        async def close(self):
+            pass
+
+        async def stream_content(self, *args, **kwargs):
+            yield b""
+
+    return FakeTelegramSession()
+
+
+# ========= LOAD =========
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))]
+
+
+def db_size(path: str) -> int:
+    return sum(os.path.getsize(p) for p in (path, f"{path}-wal", f"{path}-shm") if os.path.exists(p))
+
+
+async def run(args):
+    import webhook_app
+    import main as bot_main
+
+    logging.getLogger().setLevel(args.log_level)
+    session = make_fake_session(args.tg_latency_ms / 1000)
+    # те же middleware, что у настоящей сессии бота (см. main.py, раздел BOT)
+    session.middleware(bot_main.FloodControlMiddleware(bot_main.FLOOD_GLOBAL_RATE, bot_main.FLOOD_CHAT_RATE,
+                                                       bot_main.FLOOD_CHAT_BURST, bot_main.FLOOD_MAX_CHATS))
+    session.middleware(bot_main.BotAPIMetricsMiddleware())
+    bot_main.bot.session = session
+
+    await webhook_app.on_startup()
+    # WAL после миграций уже обрезан (main.migrate), так что меряется только рост данных
+    size_before = db_size(bot_main.DB_PATH)
+
+    update_ids = itertools.count(1)
+    ack_latencies: list[float] = []
+    e2e_latencies: list[float] = []
+    counters = {"ok": 0, "failed": 0, "timeout": 0, "rejected": 0}
+    gate = asyncio.Semaphore(max(1, args.concurrency))
+    url = f"/webhook/{webhook_app.WEBHOOK_SECRET}"
+
+    async def user(client: httpx.AsyncClient, user_id: int):
+        sender = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "language_code": "ru"}
+        async with gate:
+            for i in range(args.messages):
+                update_id = next(update_ids)
+                update = {"update_id": update_id, "message": {
+                    "message_id": update_id, "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"}, "from": sender,
+                    "text": f"Привет, это сообщение {i} для нагрузочного теста, как у тебя дела?",
+                }}
+                reply = asyncio.get_running_loop().create_future()
+                session.waiters[user_id] = reply
+                started = time.perf_counter()
+                r = await client.post(url, json=update)
+                ack_latencies.append(time.perf_counter() - started)
+                if r.status_code != 200:
+                    session.waiters.pop(user_id, None)
+                    counters["rejected"] += 1
+                    continue
+                try:
+                    ok = await asyncio.wait_for(reply, args.timeout)
+                except asyncio.TimeoutError:
+                    session.waiters.pop(user_id, None)
+                    counters["timeout"] += 1
+                    continue
+                e2e_latencies.append(time.perf_counter() - started)
+                counters["ok" if ok else "failed"] += 1
+                if args.think_ms:
+                    await asyncio.sleep(args.think_ms / 1000)
+
+    transport = httpx.ASGITransport(app=webhook_app.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(user(client, 10_000 + n) for n in range(args.users)))
+        elapsed = time.perf_counter() - started
+        health = (await client.get("/health")).json()
+
+    await webhook_app.on_shutdown()
+    size_after = db_size(bot_main.DB_PATH)
+
+    total = args.users * args.messages
+    ms = lambda values, q: f"{percentile(values, q) * 1000:.1f}"
+    print(f"\n=== loadtest: {args.users} users x {args.messages} msg, concurrency {args.concurrency}, "
+          f"{'stream' if args.stream else 'plain'}, LLM {args.llm_latency_ms:.0f} ms, "
+          f"Bot API {args.tg_latency_ms:.0f} ms ===")
+    print(f"elapsed:      {elapsed:.2f} s")
+    print(f"throughput:   {counters['ok'] / elapsed:.1f} replies/s ({total / elapsed:.1f} updates/s offered)")
+    print(f"results:      " + ", ".join(f"{k}={v}" for k, v in counters.items()))
+    print(f"reply (ms):   p50={ms(e2e_latencies, 50)} p95={ms(e2e_latencies, 95)} "
+          f"p99={ms(e2e_latencies, 99)} max={ms(e2e_latencies, 100)}")
+    print(f"webhook (ms): p50={ms(ack_latencies, 50)} p95={ms(ack_latencies, 95)} "
+          f"p99={ms(ack_latencies, 99)} max={ms(ack_latencies, 100)}")
+    print(f"db size:      {size_before / 1024:.0f} KiB -> {size_after / 1024:.0f} KiB "
+          f"(+{(size_after - size_before) / max(1, total):.0f} B/update)")
+    print(f"bot api:      {session.calls}")
+    print(f"queue:        {health['queue']}")
+    print(f"llm:          {health['llm']}")
+    print(f"providers:    {health['llm_providers']}")
+    print(f"history:      {health['history_cache']}")
+
+
+def main():
+    args = parse_args()
+    fake_url, fake_server = serve_in_thread(make_fake_deepseek(args))
+
+    # окружение бота задаём до импорта main: он читает его при загрузке модуля
+    db_path = args.db or os.path.join(tempfile.mkdtemp(prefix="sophia-bench-"), "bench.db")
+    os.environ.update({
+        "BOT_TOKEN": os.getenv("BENCH_BOT_TOKEN", "123456:bench"),
+        "DEEPSEEK_API_KEY": "bench",
+        "DEEPSEEK_API_URL": fake_url,
+        "DB_PATH": db_path,
+        "STREAM_REPLIES": "1" if args.stream else "0",
+    })
+    os.environ.pop("PUBLIC_URL", None)  # не ставим настоящий вебхук
+    if args.coalesce_ms is not None:
+        os.environ["COALESCE_WINDOW_MS"] = str(args.coalesce_ms)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    try:
+        asyncio.run(run(args))
+    finally:
+        fake_server.should_exit = True
+    print(f"db path:      {db_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,11 +5,18 @@ import logging
 import httpx
 import aiosqlite
 import time
+import json
+import heapq
+import random
+import itertools
+import sys
+import contextlib
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
-from typing import Dict, Optional
+from typing import Any, AsyncIterator, Dict, Mapping, Optional
 
-from aiogram import Bot, Dispatcher, F
+from aiogram import BaseMiddleware, Bot, Dispatcher, F
 from aiogram.types import (
     Message, CallbackQuery, PreCheckoutQuery,
     InlineKeyboardMarkup, InlineKeyboardButton,
@@ -17,15 +24,21 @@ from aiogram.types import (
     LabeledPrice, FSInputFile,
 )
 from aiogram.filters import CommandStart, Command
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
-import csv, tempfile
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.methods import SendChatAction
+from prometheus_client import Counter, Gauge, Histogram
+import csv, gzip, shutil, tempfile
 
 # ========= ENV =========
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
 DEEPSEEK_MODEL = os.getenv("DEEPSEEK_MODEL", "deepseek-chat")
+DEEPSEEK_API_URL = os.getenv("DEEPSEEK_API_URL", "https://api.deepseek.com").rstrip("/")
 DB_PATH = os.getenv("DB_PATH", "bot.db")
 ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))  # переменная в Render уже добавлена
 
@@ -42,22 +55,137 @@ PREMIUM_DAYS_WEEK  = int(os.getenv("PREMIUM_DAYS_WEEK", "7"))
 # Контекст диалога — сколько последних пар реплик подмешивать
 HISTORY_MAX_TURNS = int(os.getenv("HISTORY_MAX_TURNS", "15"))
 
-logging.basicConfig(level=logging.INFO)
-bot = Bot(BOT_TOKEN)
-dp = Dispatcher()
-
-class Feedback(StatesGroup):
-    waiting_kind = State()  # выбор: отзыв или жалоба
-    waiting_text = State()  # ожидание текста
-
+# HTTP-клиент DeepSeek: таймауты (сек), лимиты пула и keep-alive; HTTP/2 включается только если установлен пакет h2
+DEEPSEEK_CONNECT_TIMEOUT = float(os.getenv("DEEPSEEK_CONNECT_TIMEOUT", "5"))
+DEEPSEEK_READ_TIMEOUT = float(os.getenv("DEEPSEEK_READ_TIMEOUT", "40"))
+DEEPSEEK_MAX_CONNECTIONS = int(os.getenv("DEEPSEEK_MAX_CONNECTIONS", "20"))
+DEEPSEEK_MAX_KEEPALIVE = int(os.getenv("DEEPSEEK_MAX_KEEPALIVE", "10"))
+DEEPSEEK_KEEPALIVE_EXPIRY = float(os.getenv("DEEPSEEK_KEEPALIVE_EXPIRY", "60"))
+DEEPSEEK_HTTP2 = os.getenv("DEEPSEEK_HTTP2", "1") == "1"
+
+# Потоковые ответы (опционально): первый кусок отправляется сразу, дальше сообщение
+# редактируется не чаще раза в STREAM_EDIT_INTERVAL сек (Telegram режет частые правки)
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "0") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+
+# Кеш статуса доступа (триал/премиум) в памяти процесса: сколько пользователей держать и сколько секунд доверять
+ACCESS_CACHE_SIZE = int(os.getenv("ACCESS_CACHE_SIZE", "10000"))
+ACCESS_CACHE_TTL = float(os.getenv("ACCESS_CACHE_TTL", "300"))
+
+# Групповая запись истории: сколько секунд копить реплики разных пользователей перед одним коммитом
+DIALOG_FLUSH_INTERVAL = float(os.getenv("DIALOG_FLUSH_INTERVAL", "0.05"))
+
+# LRU-кеш последних реплик в памяти: потолок по памяти (МБ) на все закешированные истории
+HISTORY_CACHE_MAX_MB = float(os.getenv("HISTORY_CACHE_MAX_MB", "32"))
+
+# Планировщик запросов к DeepSeek: сколько запросов одновременно, сколько секунд можно ждать
+# своей очереди и сколько раз повторять при 429/5xx (с учётом Retry-After и джиттером)
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "30"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "20"))
+
+# Провайдеры LLM (OpenAI-совместимые): список имён через запятую; для имени NAME читаются
+# NAME_API_URL, NAME_API_KEY, NAME_MODEL (deepseek берёт DEEPSEEK_* выше). Если лучший провайдер
+# не ответил за LLM_HEDGE_DELAY сек, параллельно спрашиваем следующий (0 — не хеджировать);
+# при ошибке сразу переходим к следующему
+LLM_PROVIDER_NAMES = [n.strip() for n in os.getenv("LLM_PROVIDERS", "deepseek").split(",") if n.strip()]
+LLM_HEDGE_DELAY = float(os.getenv("LLM_HEDGE_DELAY", "4"))
+LLM_PROVIDER_MAX_FAILS = int(os.getenv("LLM_PROVIDER_MAX_FAILS", "3"))
+LLM_PROVIDER_COOLDOWN = float(os.getenv("LLM_PROVIDER_COOLDOWN", "30"))
+LLM_EWMA_ALPHA = float(os.getenv("LLM_EWMA_ALPHA", "0.2"))
+
+# Выгрузка данных админом (/export): строк за одно чтение из БД, потолок размера файла
+# (Telegram принимает от бота документы до 50 МБ) и минимум свободного места на диске
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "2000"))
+EXPORT_MAX_MB = int(os.getenv("EXPORT_MAX_MB", "45"))
+EXPORT_MIN_FREE_MB = int(os.getenv("EXPORT_MIN_FREE_MB", "200"))
+
+# Флуд-контроль исходящих вызовов Bot API: общий лимит бота (сообщений/с), лимит и всплеск на один чат,
+# сколько раз повторять после RetryAfter и сколько чатов помнить
+FLOOD_GLOBAL_RATE = float(os.getenv("FLOOD_GLOBAL_RATE", "30"))
+FLOOD_CHAT_RATE = float(os.getenv("FLOOD_CHAT_RATE", "1"))
+FLOOD_CHAT_BURST = float(os.getenv("FLOOD_CHAT_BURST", "3"))
+FLOOD_MAX_RETRIES = int(os.getenv("FLOOD_MAX_RETRIES", "5"))
+FLOOD_MAX_CHATS = int(os.getenv("FLOOD_MAX_CHATS", "10000"))
+# RetryAfter от двух и более разных чатов за столько секунд считается общим лимитом бота — на паузу встаёт весь бот
+FLOOD_GLOBAL_WINDOW = float(os.getenv("FLOOD_GLOBAL_WINDOW", "5"))
+
+# Напоминания об окончании доступа: как часто сканировать (сек, 0 — выключить), за сколько секунд
+# до конца триала/премиума напоминать, размер порции и сообщений в секунду
+EXPIRY_SCAN_INTERVAL = float(os.getenv("EXPIRY_SCAN_INTERVAL", "600"))
+EXPIRY_NOTICE_WINDOW = int(os.getenv("EXPIRY_NOTICE_WINDOW", str(24 * 3600)))
+EXPIRY_BATCH = int(os.getenv("EXPIRY_BATCH", "200"))
+EXPIRY_RATE = float(os.getenv("EXPIRY_RATE", "10"))
+
+# Архив истории: через сколько дней тишины уносить реплики пользователя из БД в сжатые файлы
+# (0 — не архивировать), куда, как часто проверять (сек) и сколько пользователей смотреть за запрос.
+# После архивации место возвращается PRAGMA incremental_vacuum по VACUUM_STEP_PAGES страниц с паузами
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "90"))
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", os.path.join(os.path.dirname(DB_PATH) or ".", "dialog_archive"))
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", str(6 * 3600)))
+ARCHIVE_BATCH = int(os.getenv("ARCHIVE_BATCH", "500"))
+VACUUM_STEP_PAGES = int(os.getenv("VACUUM_STEP_PAGES", "256"))
+VACUUM_STEP_PAUSE = float(os.getenv("VACUUM_STEP_PAUSE", "0.2"))
+
+# Рассылка (/broadcast): сообщений в секунду (у Telegram общий лимит ~30/с на бота), размер страницы
+# получателей и как часто сохранять прогресс (сек). Повторы после RetryAfter — в FloodControlMiddleware
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_PAGE = int(os.getenv("BROADCAST_PAGE", "500"))
+BROADCAST_CHECKPOINT_SEC = float(os.getenv("BROADCAST_CHECKPOINT_SEC", "1"))
+# Рассылку ведёт один процесс — тот, кто держит аренду; аренда продлевается на каждой отметке,
+# и если процесс умер, через BROADCAST_LEASE_SEC сек рассылку подхватит другой
+BROADCAST_LEASE_SEC = int(os.getenv("BROADCAST_LEASE_SEC", "30"))
+
+# Бюджет промпта в токенах (оценка без токенизатора): история добирается от новых реплик к старым,
+# пока влезает; слишком длинная реплика истории обрезается до HISTORY_MSG_MAX_TOKENS
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "6000"))
+PROMPT_TOKEN_BUDGET_PREMIUM = int(os.getenv("PROMPT_TOKEN_BUDGET_PREMIUM", str(PROMPT_TOKEN_BUDGET)))
+HISTORY_MSG_MAX_TOKENS = int(os.getenv("HISTORY_MSG_MAX_TOKENS", "800"))
+# Начало истории в промпте сдвигается блоками по HISTORY_TRIM_BLOCK реплик, а не по одной —
+# так префикс промпта остаётся байт-в-байт одинаковым несколько ходов подряд (кеш префиксов DeepSeek)
+HISTORY_TRIM_BLOCK = int(os.getenv("HISTORY_TRIM_BLOCK", "8"))
+
+# Склейка «очередей» сообщений: сообщения, пришедшие за COALESCE_WINDOW_MS мс (или пока
+# ответ пользователю ещё генерируется), уходят в модель одной репликой. Окно — добавка
+# к задержке каждого ответа, поэтому короткое: длинные серии и так склеиваются, пока идёт генерация
+COALESCE_WINDOW_MS = int(os.getenv("COALESCE_WINDOW_MS", "250"))
+
+# Кеш профилей (write-through: set_profile сразу обновляет запись)
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "10000"))
+PROFILE_CACHE_TTL = float(os.getenv("PROFILE_CACHE_TTL", "600"))
+
+# FSM-состояния хранятся в SQLite (общие для всех воркеров/инстансов); чтения кешируются
+# в процессе на FSM_CACHE_TTL сек (0 — без кеша; при DB_PROCESSES > 1 кеш выключен всегда)
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "10000"))
+FSM_CACHE_TTL = float(os.getenv("FSM_CACHE_TTL", "2"))
+
+# Сколько процессов работает с одной БД (uvicorn --workers берёт WEB_CONCURRENCY). Кеши в памяти
+# процесса не узнают о записях соседей, поэтому при DB_PROCESSES > 1 кеши доступа, профилей, FSM
+# и истории выключены, а общий лимит Bot API делится между процессами. В пределах процесса
+# остаются: склейка сообщений и порядок ответов в чате (Telegram может отдать апдейты одного чата
+# разным воркерам), буфер DialogWriter (соседи видят реплику после сброса, через
+# DIALOG_FLUSH_INTERVAL) и LLM_MAX_CONCURRENCY. Метрики со всех воркеров собирает
+# PROMETHEUS_MULTIPROC_DIR (см. webhook_app)
+DB_PROCESSES = max(1, int(os.getenv("DB_PROCESSES", os.getenv("WEB_CONCURRENCY", "1"))))
+if DB_PROCESSES > 1:
+    ACCESS_CACHE_TTL = PROFILE_CACHE_TTL = FSM_CACHE_TTL = 0.0
+    HISTORY_CACHE_MAX_MB = 0.0
+    FLOOD_GLOBAL_RATE /= DB_PROCESSES
+
+# Пул соединений к SQLite: сколько держать открытыми и сколько подготовленных выражений кешировать на соединение
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", "256"))
+# WAL: читатели не блокируют писателя и наоборот; synchronous=NORMAL в WAL безопасен от порчи БД
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+# До скольких МБ SQLite обрезает файл -wal после checkpoint (после VACUUM он вырастает до размера БД)
+DB_JOURNAL_SIZE_LIMIT_MB = int(os.getenv("DB_JOURNAL_SIZE_LIMIT_MB", "64"))
+# Все записи идут через одного писателя, который объединяет до DB_WRITE_BATCH задач в транзакцию
+DB_WRITE_BATCH = int(os.getenv("DB_WRITE_BATCH", "256"))
 
-@dp.message(Command("ping"))
-async def ping(m: Message):
-    await m.answer("pong")
-
-# ========= Память «ожидаемого ввода» для редактирования профиля =========
-# user_id -> "name" | "age" | "interests"
-PENDING_EDIT: Dict[int, str] = {}
+logging.basicConfig(level=logging.INFO)
 
 # ========= SYSTEM PROMPT (EN) =========
 SYSTEM_PROMPT = """
@@ -132,6 +260,526 @@ def now_ts() -> int:
 def iso_now() -> str:
     return datetime.now(timezone.utc).isoformat()
 
+# ========= METRICS =========
+# Метрики Prometheus; отдаются через /metrics в webhook_app
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+
+# multiprocess_mode: при PROMETHEUS_MULTIPROC_DIR значения живых воркеров суммируются
+UPDATES_IN_FLIGHT = Gauge("sophia_updates_in_flight", "Updates currently being processed",
+                          multiprocess_mode="livesum")
+LLM_QUEUE_DEPTH = Gauge("sophia_llm_queue_depth", "Requests waiting for a DeepSeek slot",
+                        multiprocess_mode="livesum")
+UPDATE_SECONDS = Histogram("sophia_update_seconds",
+                           "Update processing time by aiogram handler (reply_to_turn: full reply to a text turn)",
+                           ["handler"], buckets=LATENCY_BUCKETS)
+UPDATE_ERRORS = Counter("sophia_update_errors_total", "Handler exceptions", ["handler", "error"])
+LLM_SECONDS = Histogram("sophia_llm_request_seconds", "LLM HTTP attempt time (stream: until the last chunk)",
+                        ["mode", "provider", "outcome"], buckets=LATENCY_BUCKETS)
+LLM_ERRORS = Counter("sophia_llm_errors_total", "LLM failed attempts by error class",
+                     ["mode", "provider", "error"])
+DB_SECONDS = Histogram("sophia_db_seconds", "SQLite operation time (pool wait / writer queue included)",
+                       ["op"], buckets=DB_BUCKETS)
+DB_WRITER_BATCH_JOBS = Histogram("sophia_db_writer_batch_jobs", "Jobs committed per writer transaction",
+                                 buckets=(1, 2, 5, 10, 25, 50, 100, 250))
+BOT_API_FLOOD_RETRIES = Counter("sophia_bot_api_flood_retries_total", "Bot API calls retried after RetryAfter",
+                                ["method"])
+PROMPT_TOKENS = Histogram("sophia_prompt_tokens", "Estimated prompt size in tokens", ["plan"],
+                          buckets=(250, 500, 1000, 2000, 3000, 4000, 6000, 8000, 12000, 16000))
+HISTORY_CACHE_LOOKUPS = Counter("sophia_history_cache_lookups_total", "History cache lookups", ["result"])
+HISTORY_CACHE_BYTES = Gauge("sophia_history_cache_bytes", "Approximate history cache size",
+                            multiprocess_mode="livesum")
+BOT_API_SECONDS = Histogram("sophia_bot_api_seconds", "Telegram Bot API call time",
+                            ["method", "outcome"], buckets=LATENCY_BUCKETS)
+
+def error_class(e: BaseException) -> str:
+    if isinstance(e, httpx.HTTPStatusError):
+        return f"HTTP{e.response.status_code}"
+    return type(e).__name__
+
+def observe_llm(mode: str, provider: str, started: float, error: Exception | None = None):
+    LLM_SECONDS.labels(mode, provider, "ok" if error is None else "error").observe(time.perf_counter() - started)
+    if error is not None:
+        LLM_ERRORS.labels(mode, provider, error_class(error)).inc()
+
+class InFlightMiddleware(BaseMiddleware):
+    """Внешняя middleware на dp.update: сколько апдейтов обрабатывается прямо сейчас."""
+
+    async def __call__(self, handler, event, data):
+        UPDATES_IN_FLIGHT.inc()
+        try:
+            return await handler(event, data)
+        finally:
+            UPDATES_IN_FLIGHT.dec()
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Внутренняя middleware: время и ошибки конкретного хендлера (вызывается после фильтров)."""
+
+    async def __call__(self, handler, event, data):
+        handler_obj = data.get("handler")
+        name = getattr(getattr(handler_obj, "callback", None), "__name__", "unknown")
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            UPDATE_ERRORS.labels(name, error_class(e)).inc()
+            raise
+        finally:
+            UPDATE_SECONDS.labels(name).observe(time.perf_counter() - started)
+
+class BotAPIMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: время каждого вызова Bot API по методу."""
+
+    async def __call__(self, make_request, bot, method):
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            response = await make_request(bot, method)
+            outcome = "ok"
+            return response
+        finally:
+            BOT_API_SECONDS.labels(type(method).__name__, outcome).observe(time.perf_counter() - started)
+
+# ========= DB POOL =========
+class DBPool:
+    """Общий пул долгоживущих соединений aiosqlite.
+
+    Соединения (и их рабочие потоки) открываются один раз при старте, pragma применяются
+    сразу после открытия. Подготовленные выражения живут в кеше sqlite3 на каждом
+    соединении (cached_statements), поэтому одинаковый SQL компилируется один раз.
+    """
+
+    PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        f"PRAGMA synchronous={DB_SYNCHRONOUS}",
+        f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-8000",  # ~8 МБ страничного кеша на соединение
+        f"PRAGMA journal_size_limit={DB_JOURNAL_SIZE_LIMIT_MB * 1024 * 1024}",
+    )
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = max(1, size)
+        self._conns: list[aiosqlite.Connection] = []
+        self._free: asyncio.Queue | None = None
+        self._lock = asyncio.Lock()
+
+    async def _open(self) -> aiosqlite.Connection:
+        db = await aiosqlite.connect(self.path, cached_statements=DB_STATEMENT_CACHE)
+        for pragma in self.PRAGMAS:
+            await db.execute(pragma)
+        return db
+
+    async def start(self):
+        async with self._lock:
+            if self._free is not None:
+                return
+            free: asyncio.Queue = asyncio.Queue()
+            # соединения открываются параллельно: у каждого свой поток aiosqlite, на холодном старте это заметно
+            opened = await asyncio.gather(*(self._open() for _ in range(self.size)), return_exceptions=True)
+            errors = [r for r in opened if isinstance(r, BaseException)]
+            if errors:
+                for db in opened:
+                    if not isinstance(db, BaseException):
+                        await db.close()
+                raise errors[0]
+            self._conns = list(opened)
+            for db in self._conns:
+                free.put_nowait(db)
+            self._free = free
+            logging.info("DB pool started: %s connection(s) to %s", self.size, self.path)
+
+    async def close(self):
+        async with self._lock:
+            conns, self._conns, self._free = self._conns, [], None
+            for db in conns:
+                try:
+                    await db.close()
+                except Exception:
+                    logging.exception("DB pool: failed to close connection")
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, op: str = "other"):
+        """Соединение из пула; op — метка операции для метрики sophia_db_seconds."""
+        started = time.perf_counter()
+        # ленивый старт: на случай вызова хелпера до init_db (например, из тестового скрипта)
+        if self._free is None:
+            await self.start()
+        free = self._free
+        db = await free.get()
+        try:
+            yield db
+        except BaseException:
+            # не возвращаем в пул соединение с незавершённой транзакцией
+            if db.in_transaction:
+                await db.rollback()
+            raise
+        finally:
+            free.put_nowait(db)
+            DB_SECONDS.labels(op).observe(time.perf_counter() - started)
+
+db_pool = DBPool(DB_PATH, DB_POOL_SIZE)
+
+class DBWriter:
+    """Единственный писатель в БД.
+
+    Пишущие хелперы не коммитят сами, а отдают задачу (async-функцию от соединения) в очередь.
+    Отдельная корутина на своём соединении собирает всё, что накопилось, в одну транзакцию:
+    каждая задача — в своём SAVEPOINT (ошибка одной не откатывает остальные), затем один COMMIT.
+    Вызывающий получает результат только после коммита. Чтения при этом идут через db_pool
+    параллельно (WAL).
+    """
+
+    def __init__(self, max_batch: int):
+        self.max_batch = max(1, max_batch)
+        self._queue: asyncio.Queue | None = None
+        self._db: aiosqlite.Connection | None = None
+        self._task: asyncio.Task | None = None
+        self._lock = asyncio.Lock()
+        self.batches = 0
+        self.jobs = 0
+
+    async def start(self):
+        async with self._lock:
+            if self._task is not None:
+                return
+            self._db = await db_pool._open()
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        async with self._lock:
+            if self._task is None:
+                return
+            await self._queue.join()  # дописываем всё, что уже поставлено
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            await self._db.close()
+            self._task = self._db = self._queue = None
+
+    async def run(self, job, op: str = "other"):
+        """Выполняет job(db) в транзакции писателя и возвращает её результат после коммита."""
+        started = time.perf_counter()
+        if self._task is None:
+            await self.start()
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((job, fut))
+        try:
+            return await fut
+        finally:
+            DB_SECONDS.labels(op).observe(time.perf_counter() - started)
+
+    async def execute(self, sql: str, params=(), op: str = "other") -> int:
+        """Один пишущий запрос; возвращает rowcount."""
+        async def job(db):
+            cur = await db.execute(sql, params)
+            return cur.rowcount
+        return await self.run(job, op)
+
+    async def _run(self):
+        db, queue = self._db, self._queue
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < self.max_batch and not queue.empty():
+                batch.append(queue.get_nowait())
+            results = []
+            try:
+                await db.execute("BEGIN IMMEDIATE")
+                for job, fut in batch:
+                    await db.execute("SAVEPOINT job")
+                    try:
+                        results.append((fut, await job(db), None))
+                    except Exception as e:
+                        await db.execute("ROLLBACK TO job")
+                        results.append((fut, None, e))
+                    await db.execute("RELEASE job")
+                await db.commit()
+            except Exception as e:
+                logging.exception("DB writer: batch of %s job(s) failed", len(batch))
+                if db.in_transaction:
+                    await db.rollback()
+                results = [(fut, None, e) for _, fut in batch]
+            self.batches += 1
+            self.jobs += len(batch)
+            DB_WRITER_BATCH_JOBS.observe(len(batch))
+            for fut, result, error in results:
+                if not fut.done():
+                    if error is not None:
+                        fut.set_exception(error)
+                    else:
+                        fut.set_result(result)
+                queue.task_done()
+
+db_writer = DBWriter(DB_WRITE_BATCH)
+
+async def close_db():
+    await dialog_writer.stop()
+    await db_writer.stop()
+    await db_pool.close()
+
+# ========= CACHES =========
+class TTLCache:
+    """Ограниченный по размеру LRU-кеш с TTL записей (живёт в памяти одного процесса; ttl <= 0 — выключен).
+
+    Промах читает БД под reserve(): если за время чтения запись сбросили (pop) или обновили
+    (set / patch после записи в БД), set(..., token) прочитанное значение не кладёт —
+    иначе устаревшая строка жила бы в кеше весь TTL.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = max(1, maxsize)
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        # key -> метка идущего чтения из БД; потерянная метка лишь значит, что значение не закешируется
+        self._reserved: OrderedDict = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def reserve(self, key) -> object:
+        token = self._reserved[key] = object()
+        self._reserved.move_to_end(key)
+        while len(self._reserved) > self.maxsize:
+            self._reserved.popitem(last=False)
+        return token
+
+    def set(self, key, value, token: object | None = None):
+        if token is not None and self._reserved.get(key) is not token:
+            return
+        self._reserved.pop(key, None)
+        if self.ttl <= 0:
+            return
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def patch(self, key, update):
+        """После записи в БД: update(старое значение) -> новое; незакешированную запись не заводит."""
+        self._reserved.pop(key, None)
+        value = self.get(key)
+        if value is not None:
+            self.set(key, update(value))
+
+    def pop(self, key):
+        self._data.pop(key, None)
+        self._reserved.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+# user_id -> (trial_end_ts, premium_until_ts); пишущие хелперы обновляют или сбрасывают запись
+ACCESS_CACHE = TTLCache(ACCESS_CACHE_SIZE, ACCESS_CACHE_TTL)
+
+# user_id -> профиль (dict как у get_profile); пустой dict — «профиля нет»
+PROFILE_CACHE = TTLCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
+
+# ========= FSM STORAGE =========
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище aiogram в таблице fsm той же БД.
+
+    Состояние видно любому процессу, поэтому webhook_app можно запускать в несколько
+    воркеров. Чтения идут через небольшой TTL-кеш в памяти, записи сразу в БД (и в кеш).
+    """
+
+    def __init__(self, cache_size: int, cache_ttl: float):
+        # ключ -> (state, data)
+        self._cache = TTLCache(cache_size, cache_ttl)
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ":".join(str(part) if part is not None else "" for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny,
+        ))
+
+    async def _load(self, key: str) -> tuple[str | None, dict]:
+        cached = self._cache.get(key)
+        if cached is None:
+            token = self._cache.reserve(key)
+            async with db_pool.acquire("fsm_load") as db:
+                async with db.execute("SELECT state, data FROM fsm WHERE key=?", (key,)) as cur:
+                    row = await cur.fetchone()
+            cached = (row[0], json.loads(row[1])) if row else (None, {})
+            self._cache.set(key, cached, token)
+        return cached
+
+    async def _save(self, key: str, column: str, value):
+        stored = json.dumps(value, ensure_ascii=False) if column == "data" else value
+
+        async def job(db):
+            await db.execute(f"""
+                INSERT INTO fsm (key, {column}, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET {column}=excluded.{column}, updated_at=excluded.updated_at
+            """, (key, stored, now_ts()))
+            # пустые записи (после state.clear()) не храним
+            await db.execute("DELETE FROM fsm WHERE key=? AND state IS NULL AND data='{}'", (key,))
+        await db_writer.run(job, op="fsm_save")
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        state = state.state if isinstance(state, State) else state
+        k = self._key(key)
+        await self._save(k, "state", state)
+        self._cache.patch(k, lambda cached: (state, cached[1]))
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        state, _ = await self._load(self._key(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        data = dict(data)
+        k = self._key(key)
+        await self._save(k, "data", data)
+        self._cache.patch(k, lambda cached: (cached[0], data))
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        _, data = await self._load(self._key(key))
+        return dict(data)
+
+    async def close(self) -> None:
+        # соединения принадлежат db_pool и закрываются в close_db
+        pass
+
+# ========= FLOOD CONTROL =========
+class TokenBucket:
+    """Ограничитель скорости: rate токенов в секунду, не больше capacity подряд.
+
+    pause() замораживает выдачу (после RetryAfter от Telegram ждут все, а не один запрос);
+    за время паузы бакет наполняется, поэтому первый вызов после неё не ждёт ещё 1/rate.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class FloodControlMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: все исходящие вызовы с chat_id идут через лимиты Telegram.
+
+    Вызовы одного чата выполняются строго по очереди (FIFO-lock на чат), каждый берёт токен
+    из бакета чата (FLOOD_CHAT_RATE) и из общего бакета бота (FLOOD_GLOBAL_RATE). На
+    TelegramRetryAfter на паузу встаёт чат, и вызов повторяется (до FLOOD_MAX_RETRIES раз),
+    так что хендлеры получают результат, а не исключение флуд-контроля. По ответу не понять,
+    какой лимит превышен, поэтому весь бот ставится на паузу, только если RetryAfter пришёл
+    от двух и более разных чатов за FLOOD_GLOBAL_WINDOW сек: флуд одного чата остальных не тормозит.
+    """
+
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: float, max_chats: int):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_chats = max_chats
+        self._chats: OrderedDict[int | str, tuple[asyncio.Lock, TokenBucket]] = OrderedDict()
+        # chat_id -> время последнего RetryAfter (только за последние FLOOD_GLOBAL_WINDOW сек)
+        self._retry_after_chats: dict[int | str, float] = {}
+
+    def _chat(self, chat_id: int | str) -> tuple[asyncio.Lock, TokenBucket]:
+        entry = self._chats.get(chat_id)
+        if entry is not None:
+            self._chats.move_to_end(chat_id)
+            return entry
+        entry = self._chats[chat_id] = (asyncio.Lock(), TokenBucket(self.chat_rate, self.chat_burst))
+        if len(self._chats) > self.max_chats:
+            # забываем самые давние чаты, у которых сейчас ничего не отправляется
+            for old_id in itertools.islice(list(self._chats), len(self._chats) - self.max_chats):
+                if not self._chats[old_id][0].locked():
+                    del self._chats[old_id]
+        return entry
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None or isinstance(method, SendChatAction):
+            # answer_callback_query, get_me, «печатает…» — не сообщения, лимиты на них не тратим
+            return await make_request(bot, method)
+        lock, bucket = self._chat(chat_id)
+        async with lock:
+            for attempt in itertools.count():
+                await bucket.acquire()
+                await self.global_bucket.acquire()
+                try:
+                    return await make_request(bot, method)
+                except TelegramRetryAfter as e:
+                    if attempt >= FLOOD_MAX_RETRIES:
+                        raise
+                    BOT_API_FLOOD_RETRIES.labels(type(method).__name__).inc()
+                    logging.warning("Flood control on %s in chat %s: retry in %ss",
+                                    type(method).__name__, chat_id, e.retry_after)
+                    bucket.pause(e.retry_after)
+                    if self._hit_global_limit(chat_id):
+                        logging.warning("Flood control in several chats: pausing the whole bot for %ss", e.retry_after)
+                        self.global_bucket.pause(e.retry_after)
+
+    def _hit_global_limit(self, chat_id: int | str) -> bool:
+        """Запоминает RetryAfter чата; True, если за окно их получили хотя бы два разных чата."""
+        now = time.monotonic()
+        self._retry_after_chats = {
+            cid: ts for cid, ts in self._retry_after_chats.items() if now - ts < FLOOD_GLOBAL_WINDOW
+        }
+        self._retry_after_chats[chat_id] = now
+        return len(self._retry_after_chats) >= 2
+
+# ========= BOT =========
+bot = Bot(BOT_TOKEN)
+dp = Dispatcher(storage=SQLiteStorage(FSM_CACHE_SIZE, FSM_CACHE_TTL))
+# порядок важен: флуд-контроль снаружи, метрики внутри — меряем сами вызовы API, без ожидания лимитов
+bot.session.middleware(FloodControlMiddleware(FLOOD_GLOBAL_RATE, FLOOD_CHAT_RATE, FLOOD_CHAT_BURST, FLOOD_MAX_CHATS))
+bot.session.middleware(BotAPIMetricsMiddleware())
+dp.update.outer_middleware(InFlightMiddleware())
+for _name, _observer in dp.observers.items():
+    if _name not in ("update", "error"):
+        _observer.middleware(HandlerMetricsMiddleware())
+
+class Feedback(StatesGroup):
+    waiting_kind = State()  # выбор: отзыв или жалоба
+    waiting_text = State()  # ожидание текста
+
+class ProfileEdit(StatesGroup):
+    # ожидаем ответ для редактирования профиля (раньше — словарь PENDING_EDIT в памяти процесса)
+    name = State()
+    age = State()
+    interests = State()
+
+# состояние → поле профиля
+PROFILE_EDIT_FIELDS = {
+    ProfileEdit.name.state: "name",
+    ProfileEdit.age.state: "age",
+    ProfileEdit.interests.state: "interests",
+}
+
+
+@dp.message(Command("ping"))
+async def ping(m: Message):
+    await m.answer("pong")
+
 # ========= HELPERS =========
 def profile_to_text(p: dict | None) -> str:
     if not p:
@@ -171,62 +819,81 @@ def subscription_choose_plan():
     ])
 
 async def ensure_user_exists(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT OR IGNORE INTO users(user_id, created_at) VALUES (?, ?)",
-            (user_id, iso_now())
-        )
-        await db.commit()
+    await db_writer.execute(
+        "INSERT OR IGNORE INTO users(user_id, created_at) VALUES (?, ?)",
+        (user_id, iso_now()), op="ensure_user_exists"
+    )
 
 async def set_premium_until_ts(user_id: int, until_ts: int, plan: str | None):
-    # храним как epoch-в-строке — твой get_premium_until_ts это понимает
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            INSERT INTO premium(user_id, premium_until, plan)
-            VALUES (?, ?, ?)
-            ON CONFLICT(user_id) DO UPDATE SET premium_until=?, plan=?
-        """, (user_id, str(until_ts), plan, str(until_ts), plan))
-        await db.commit()
+    # premium_until — целый unix-ts (см. миграцию 3)
+    await db_writer.execute("""
+        INSERT INTO premium(user_id, premium_until, plan)
+        VALUES (?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET premium_until=excluded.premium_until, plan=excluded.plan
+    """, (user_id, int(until_ts), plan), op="set_premium_until_ts")
+    ACCESS_CACHE.patch(user_id, lambda cached: (cached[0], int(until_ts)))
 
 async def grant_premium_days(user_id: int, days: int, plan: str):
-    now = now_ts()
-    current = await get_premium_until_ts(user_id)  # 0 если нет
-    base = max(now, current)                       # продлеваем от большего
-    until = base + days * 86400
-    await set_premium_until_ts(user_id, until, plan)
+    # продлеваем от большего из «сейчас» и текущего срока; чтение и запись — одной задачей
+    # писателя, чтобы два параллельных продления не потеряли друг друга
+    async def job(db):
+        async with db.execute(
+            """
+            INSERT INTO premium(user_id, premium_until, plan) VALUES (?, ? + ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                premium_until=MAX(premium.premium_until, excluded.premium_until - ?) + ?,
+                plan=excluded.plan
+            RETURNING premium_until
+            """,
+            (user_id, now_ts(), days * 86400, plan, days * 86400, days * 86400)
+        ) as cur:
+            row = await cur.fetchone()
+        return int(row[0])
+    until = await db_writer.run(job, op="grant_premium_days")
+    ACCESS_CACHE.patch(user_id, lambda cached: (cached[0], until))
     return until
 
 
 async def ensure_trial(user_id: int):
-    await ensure_user_exists(user_id)
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
+    # триал уже выдан — в БД не ходим
+    cached = ACCESS_CACHE.get(user_id)
+    if cached is not None and cached[0]:
+        return
+    async with db_pool.acquire("ensure_trial") as db:
+        async with db.execute(
             "SELECT trial_start_ts, trial_end_ts FROM users WHERE user_id=?",
             (user_id,)
-        )
-        row = await cur.fetchone()
-        start_ts, end_ts = (row or (None, None))
-        if start_ts is None or end_ts is None:
-            start = now_ts()
-            end = start + FREE_TRIAL_DAYS * 86400
-            await db.execute(
-                "UPDATE users SET trial_start_ts=?, trial_end_ts=? WHERE user_id=?",
-                (start, end, user_id)
-            )
-            await db.commit()
+        ) as cur:
+            row = await cur.fetchone()
+    start_ts, end_ts = (row or (None, None))
+    if start_ts is not None and end_ts is not None:
+        return
+    start = now_ts()
+    end = start + FREE_TRIAL_DAYS * 86400
 
-async def get_premium_until_ts(user_id: int) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT premium_until FROM premium WHERE user_id=?",
-            (user_id,)
+    async def job(db):
+        await db.execute(
+            "INSERT OR IGNORE INTO users(user_id, created_at) VALUES (?, ?)",
+            (user_id, iso_now())
+        )
+        # условие повторяем в UPDATE: между чтением и записью триал мог выдать параллельный апдейт
+        await db.execute(
+            "UPDATE users SET trial_start_ts=?, trial_end_ts=? "
+            "WHERE user_id=? AND (trial_start_ts IS NULL OR trial_end_ts IS NULL)",
+            (start, end, user_id)
         )
-        row = await cur.fetchone()
+    await db_writer.run(job, op="ensure_trial")
+    ACCESS_CACHE.pop(user_id)
+
+def parse_premium_until(val) -> int:
+    """Старый формат premium_until (TEXT: epoch-строка или ISO-дата) → unix-ts; 0 если не разобрать.
 
-    if not row or not row[0]:
+    Нужен только миграции 3, которая переводит таблицу premium на целые epoch.
+    """
+    if not val:
         return 0
 
-    val = str(row[0]).strip()
+    val = str(val).strip()
     # если пришло число в строке — трактуем как epoch
     if val.isdigit():
         try:
@@ -244,19 +911,36 @@ async def get_premium_until_ts(user_id: int) -> int:
     except Exception:
         return 0
 
-async def is_access_allowed(user_id: int) -> bool:
-    now = now_ts()
-    # trial_end_ts из users
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT COALESCE(trial_end_ts, 0) FROM users WHERE user_id=?",
+async def get_premium_until_ts(user_id: int) -> int:
+    async with db_pool.acquire("get_premium_until_ts") as db:
+        async with db.execute(
+            "SELECT premium_until FROM premium WHERE user_id=?",
             (user_id,)
-        )
-        row = await cur.fetchone()
-    trial_end = int(row[0]) if row and row[0] else 0
-
-    premium_until = await get_premium_until_ts(user_id)
+        ) as cur:
+            row = await cur.fetchone()
+    return int(row[0]) if row else 0
+
+async def get_access_status(user_id: int) -> tuple[int, int]:
+    """(trial_end_ts, premium_until_ts) пользователя; на горячем пути берётся из ACCESS_CACHE."""
+    cached = ACCESS_CACHE.get(user_id)
+    if cached is not None:
+        return cached
+    token = ACCESS_CACHE.reserve(user_id)
+    # оба значения одним запросом
+    async with db_pool.acquire("get_access_status") as db:
+        async with db.execute("""
+            SELECT
+                (SELECT COALESCE(trial_end_ts, 0) FROM users WHERE user_id=?),
+                (SELECT premium_until FROM premium WHERE user_id=?)
+        """, (user_id, user_id)) as cur:
+            row = await cur.fetchone()
+    status = (int(row[0] or 0), int(row[1] or 0))
+    ACCESS_CACHE.set(user_id, status, token)
+    return status
 
+async def is_access_allowed(user_id: int) -> bool:
+    now = now_ts()
+    trial_end, premium_until = await get_access_status(user_id)
     return now <= max(trial_end, premium_until)
 
 def days_left(from_ts: int, to_ts: int) -> int:
@@ -266,107 +950,278 @@ def days_left(from_ts: int, to_ts: int) -> int:
     return (to_ts - from_ts + 86399) // 86400
 
 # ========= DB =========
-async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        # пользователи (добавили колонки trial_* для бесплатной недели)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                created_at TEXT NOT NULL,
-                trial_start_ts INTEGER,   -- unix-ts начала триала
-                trial_end_ts   INTEGER    -- unix-ts конца триала
-            )
-        """)
-
-        # лимиты (останутся, но использовать не будем — на будущее/совместимость)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS usage (
-                user_id INTEGER NOT NULL,
-                day TEXT NOT NULL,
-                cnt INTEGER NOT NULL DEFAULT 0,
-                PRIMARY KEY (user_id, day)
-            )
-        """)
-
-        # премиум (+ план) — как было (premium_until хранится TEXT, не трогаем)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS premium (
-                user_id INTEGER PRIMARY KEY,
-                premium_until TEXT NOT NULL,
-                plan TEXT
-            )
-        """)
-
-        # профиль — без изменений
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS profile (
-                user_id INTEGER PRIMARY KEY,
-                name TEXT,
-                age INTEGER,
-                interests TEXT,
-                about TEXT,
-                updated_at TEXT
-            )
-        """)
-
-        # история диалога — без изменений
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS dialog (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                role TEXT NOT NULL,         -- 'user' | 'assistant'
-                content TEXT NOT NULL,
-                ts TEXT NOT NULL
-            )
-        """)
-
-        # новая таблица: обратная связь (отзывы/жалобы)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS feedback (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                kind TEXT NOT NULL,      -- 'review' | 'complaint'
-                text TEXT NOT NULL,
-                created_at INTEGER NOT NULL
+# Схема ведётся версиями: номер применённой миграции хранится в PRAGMA user_version,
+# каждая миграция выполняется ровно один раз в своей транзакции.
+class NoTransaction(str):
+    """Шаг миграции, который SQLite не выполняет в транзакции (VACUUM и т.п.).
+
+    Такие шаги идут до транзакции миграции, поэтому должны быть идемпотентными:
+    если процесс упадёт до записи user_version, они выполнятся ещё раз.
+    """
+
+async def _add_column_if_missing(db, table: str, column: str, decl: str):
+    async with db.execute(f"PRAGMA table_info({table})") as cur:
+        columns = {row[1] for row in await cur.fetchall()}
+    if column not in columns:
+        await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+async def _migration_1_base_schema(db):
+    # пользователи (добавили колонки trial_* для бесплатной недели)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            created_at TEXT NOT NULL,
+            trial_start_ts INTEGER,   -- unix-ts начала триала
+            trial_end_ts   INTEGER    -- unix-ts конца триала
+        )
+    """)
+
+    # лимиты (останутся, но использовать не будем — на будущее/совместимость)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS usage (
+            user_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            cnt INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, day)
+        )
+    """)
+
+    # премиум (+ план) — как было (premium_until хранится TEXT, не трогаем)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS premium (
+            user_id INTEGER PRIMARY KEY,
+            premium_until TEXT NOT NULL,
+            plan TEXT
+        )
+    """)
+
+    # профиль — без изменений
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS profile (
+            user_id INTEGER PRIMARY KEY,
+            name TEXT,
+            age INTEGER,
+            interests TEXT,
+            about TEXT,
+            updated_at TEXT
+        )
+    """)
+
+    # история диалога — без изменений
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS dialog (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            role TEXT NOT NULL,         -- 'user' | 'assistant'
+            content TEXT NOT NULL,
+            ts TEXT NOT NULL
+        )
+    """)
+
+    # обратная связь (отзывы/жалобы)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS feedback (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,      -- 'review' | 'complaint'
+            text TEXT NOT NULL,
+            created_at INTEGER NOT NULL
+        )
+    """)
+
+    # на случай старых БД (созданных до миграций) — добавим недостающие колонки
+    await _add_column_if_missing(db, "users", "trial_start_ts", "INTEGER")
+    await _add_column_if_missing(db, "users", "trial_end_ts", "INTEGER")
+    await _add_column_if_missing(db, "premium", "plan", "TEXT")
+
+async def _migration_3_premium_epoch(db):
+    # premium_until хранился TEXT (epoch-строка или ISO-дата) — пересобираем таблицу с INTEGER.
+    # Конвертация одним INSERT ... SELECT через Python-функцию: без загрузки строк в память.
+    await db.create_function("parse_premium_until", 1, parse_premium_until, deterministic=True)
+    await db.execute("""
+        CREATE TABLE premium_new (
+            user_id INTEGER PRIMARY KEY,
+            premium_until INTEGER NOT NULL,   -- unix-ts конца премиума
+            plan TEXT
+        )
+    """)
+    await db.execute("""
+        INSERT INTO premium_new (user_id, premium_until, plan)
+        SELECT user_id, parse_premium_until(premium_until), plan FROM premium
+    """)
+    await db.execute("DROP TABLE premium")
+    await db.execute("ALTER TABLE premium_new RENAME TO premium")
+    # «у кого премиум кончается в ближайшие N часов» — диапазон по индексу
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_premium_until ON premium(premium_until)")
+
+# (версия, описание, шаги: SQL-строки или async-функции от соединения)
+MIGRATIONS = [
+    (1, "base schema", [_migration_1_base_schema]),
+    (2, "indexes for hot queries", [
+        # история пользователя по порядку: WHERE user_id=? ORDER BY id
+        "CREATE INDEX IF NOT EXISTS idx_dialog_user ON dialog(user_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_feedback_user ON feedback(user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_feedback_created ON feedback(created_at)",
+    ]),
+    (3, "premium_until as integer epoch", [_migration_3_premium_epoch]),
+    (4, "FSM storage", [
+        """
+        CREATE TABLE IF NOT EXISTS fsm (
+            key TEXT PRIMARY KEY,           -- bot:chat:user:thread:business:destiny
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}', -- JSON
+            updated_at INTEGER NOT NULL
+        )
+        """,
+    ]),
+    (5, "broadcasts", [
+        """
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL,                  -- 'running' | 'done' | 'cancelled'
+            last_user_id INTEGER NOT NULL DEFAULT 0, -- всем с user_id <= отправлено
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            created_at INTEGER NOT NULL,
+            finished_at INTEGER
+        )
+        """,
+    ]),
+    (6, "expiry reminders", [
+        "CREATE INDEX IF NOT EXISTS idx_users_trial_end ON users(trial_end_ts)",
+        """
+        CREATE TABLE IF NOT EXISTS expiry_notices (
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,          -- 'trial' | 'premium'
+            expires_at INTEGER NOT NULL, -- срок, о котором напомнили (после продления будет новый)
+            sent_at INTEGER NOT NULL,
+            PRIMARY KEY (user_id, kind, expires_at)
+        ) WITHOUT ROWID
+        """,
+    ]),
+    (7, "dialog archive and incremental vacuum", [
+        # auto_vacuum меняется только пересборкой файла; VACUUM не работает внутри транзакции
+        NoTransaction("PRAGMA auto_vacuum=INCREMENTAL"),
+        NoTransaction("VACUUM"),
+        """
+        CREATE TABLE IF NOT EXISTS dialog_archive (
+            user_id INTEGER PRIMARY KEY,
+            path TEXT NOT NULL,          -- файл в ARCHIVE_DIR
+            offset INTEGER NOT NULL,     -- gzip-блок пользователя: смещение и длина в байтах
+            length INTEGER NOT NULL,
+            rows INTEGER NOT NULL,
+            archived_at INTEGER NOT NULL
+        )
+        """,
+    ]),
+    (8, "service key-value meta", [
+        """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            updated_at INTEGER NOT NULL
+        ) WITHOUT ROWID
+        """,
+    ]),
+    (9, "broadcast lease", [
+        "ALTER TABLE broadcasts ADD COLUMN owner TEXT",                          # процесс, который ведёт рассылку
+        "ALTER TABLE broadcasts ADD COLUMN lease_until INTEGER NOT NULL DEFAULT 0",  # unix-ts конца аренды
+    ]),
+]
+
+async def _get_user_version(db) -> int:
+    async with db.execute("PRAGMA user_version") as cur:
+        return (await cur.fetchone())[0]
+
+async def migrate(db) -> int:
+    """Применяет недостающие миграции и возвращает итоговую версию схемы."""
+    latest = MIGRATIONS[-1][0]
+    current = await _get_user_version(db)
+    if current >= latest:
+        logging.info("DB schema is up to date (v%s)", current)
+        return current
+
+    for version, title, steps in MIGRATIONS:
+        if version <= current:
+            continue
+        t0 = time.monotonic()
+        rebuilds = [step for step in steps if isinstance(step, NoTransaction)]
+        if rebuilds:
+            # VACUUM переписывает весь файл через WAL: старт (и bind порта) ждёт, а -wal растёт до размера БД
+            async with db.execute("PRAGMA page_count") as cur:
+                pages = (await cur.fetchone())[0]
+            async with db.execute("PRAGMA page_size") as cur:
+                size_mb = pages * (await cur.fetchone())[0] / 1024 / 1024
+            logging.warning(
+                "DB migration %s (%s) rewrites the whole database (%.1f MB) once; startup is blocked until it finishes",
+                version, title, size_mb
             )
-        """)
-
-        # на случай старых БД — мягко добавим недостающие колонки
-        try:
-            await db.execute("ALTER TABLE users ADD COLUMN trial_start_ts INTEGER")
-        except Exception:
-            pass
-        try:
-            await db.execute("ALTER TABLE users ADD COLUMN trial_end_ts INTEGER")
-        except Exception:
-            pass
+        for step in rebuilds:
+            await db.execute(step)
+        # IMMEDIATE: второй процесс, стартующий параллельно, подождёт и увидит новую версию
+        await db.execute("BEGIN IMMEDIATE")
         try:
-            await db.execute("ALTER TABLE premium ADD COLUMN plan TEXT")
-        except Exception:
-            pass
-
-        # полезные индексы (опционально, но ускорят выборки)
-        try:
-            await db.execute("CREATE INDEX IF NOT EXISTS idx_feedback_user ON feedback(user_id)")
-            await db.execute("CREATE INDEX IF NOT EXISTS idx_feedback_created ON feedback(created_at)")
-        except Exception:
-            pass
+            if await _get_user_version(db) >= version:
+                await db.rollback()
+                continue
+            for step in steps:
+                if isinstance(step, NoTransaction):
+                    continue
+                if callable(step):
+                    await step(db)
+                else:
+                    await db.execute(step)
+            await db.execute(f"PRAGMA user_version={version}")
+            await db.commit()
+        except BaseException:
+            await db.rollback()
+            logging.exception("DB migration %s (%s) failed", version, title)
+            raise
+        logging.info("DB migration %s (%s) applied in %.1f ms", version, title, (time.monotonic() - t0) * 1000)
+    # после миграций (особенно VACUUM) -wal может быть размером с саму БД — переносим и обрезаем сразу
+    await wal_checkpoint(db)
+    return latest
+
+async def wal_checkpoint(db):
+    """Переносит WAL в основной файл и обрезает -wal до нуля (если не мешают читатели)."""
+    async with db.execute("PRAGMA wal_checkpoint(TRUNCATE)") as cur:
+        busy, wal_pages, moved = await cur.fetchone()
+    if busy:
+        logging.warning("WAL checkpoint was blocked by readers: %s of %s page(s) moved", moved, wal_pages)
 
-        await db.commit()
+async def init_db():
+    await db_pool.start()
+    async with db_pool.acquire("migrate") as db:
+        await migrate(db)
+    await db_writer.start()
+    dialog_writer.start()
+
+# ---- служебные значения (кеш get_me и т.п.)
+async def get_meta(key: str) -> Optional[str]:
+    async with db_pool.acquire("get_meta") as db:
+        async with db.execute("SELECT value FROM meta WHERE key=?", (key,)) as cur:
+            row = await cur.fetchone()
+            return row[0] if row else None
+
+async def set_meta(key: str, value: str):
+    await db_writer.execute(
+        """
+        INSERT INTO meta (key, value, updated_at) VALUES (?, ?, ?)
+        ON CONFLICT(key) DO UPDATE SET value=excluded.value, updated_at=excluded.updated_at
+        """,
+        (key, value, int(time.time())), op="set_meta"
+    )
 
 async def ensure_user(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT 1 FROM users WHERE user_id=?", (user_id,)) as cur:
-            row = await cur.fetchone()
-            if not row:
-                await db.execute(
-                    "INSERT INTO users (user_id, created_at) VALUES (?, ?)",
-                    (user_id, datetime.now().isoformat())
-                )
-                await db.commit()
+    await db_writer.execute(
+        "INSERT OR IGNORE INTO users (user_id, created_at) VALUES (?, ?)",
+        (user_id, datetime.now().isoformat()), op="ensure_user"
+    )
 
 async def get_user_created_at(user_id: int) -> Optional[datetime]:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.acquire("get_user_created_at") as db:
         async with db.execute("SELECT created_at FROM users WHERE user_id=?", (user_id,)) as cur:
             row = await cur.fetchone()
             return datetime.fromisoformat(row[0]) if row else None
@@ -377,58 +1232,49 @@ def today_str() -> str:
 # ---- лимиты
 async def get_count(user_id: int) -> int:
     day = today_str()
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.acquire("get_count") as db:
         async with db.execute("SELECT cnt FROM usage WHERE user_id=? AND day=?", (user_id, day)) as cur:
             row = await cur.fetchone()
             return int(row[0]) if row else 0
 
 async def inc_count(user_id: int, delta: int = 1) -> None:
     day = today_str()
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("UPDATE usage SET cnt = cnt + ? WHERE user_id=? AND day=?", (delta, user_id, day))
-        if cur.rowcount == 0:
-            await db.execute("INSERT INTO usage (user_id, day, cnt) VALUES (?, ?, ?)", (user_id, day, delta))
-        await db.commit()
+    await db_writer.execute("""
+        INSERT INTO usage (user_id, day, cnt) VALUES (?, ?, ?)
+        ON CONFLICT(user_id, day) DO UPDATE SET cnt = cnt + excluded.cnt
+    """, (user_id, day, delta), op="inc_count")
 
 # ---- премиум
 async def has_premium(user_id: int) -> bool:
-    now = datetime.now()
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT premium_until FROM premium WHERE user_id=?", (user_id,)) as cur:
-            row = await cur.fetchone()
-            if not row:
-                return False
-            until = datetime.fromisoformat(row[0])
-            return now < until
+    return now_ts() < await get_premium_until_ts(user_id)
 
 async def get_premium_info(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.acquire("get_premium_info") as db:
         async with db.execute("SELECT premium_until, plan FROM premium WHERE user_id=?", (user_id,)) as cur:
             row = await cur.fetchone()
             if not row:
                 return None
-            return {"until": datetime.fromisoformat(row[0]), "plan": row[1]}
+            return {"until": datetime.fromtimestamp(row[0]), "plan": row[1]}
 
-async def grant_premium(user_id: int, days: int, plan: str):
-    until = datetime.now() + timedelta(days=days)
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            INSERT INTO premium (user_id, premium_until, plan) VALUES (?, ?, ?)
-            ON CONFLICT(user_id) DO UPDATE SET
-                premium_until=excluded.premium_until,
-                plan=excluded.plan
-        """, (user_id, until.isoformat(), plan))
-        await db.commit()
+async def grant_premium(user_id: int, days: int, plan: str) -> int:
+    # в отличие от grant_premium_days — не продлевает, а ставит срок от текущего момента
+    until = now_ts() + days * 86400
+    await set_premium_until_ts(user_id, until, plan)
+    return until
 
 # ---- профиль
 async def get_profile(user_id: int) -> dict | None:
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT name, age, interests, about, updated_at FROM profile WHERE user_id=?",
-                              (user_id,)) as cur:
-            row = await cur.fetchone()
-            if not row:
-                return None
-            return {"name": row[0], "age": row[1], "interests": row[2], "about": row[3], "updated_at": row[4]}
+    cached = PROFILE_CACHE.get(user_id)
+    if cached is None:
+        token = PROFILE_CACHE.reserve(user_id)
+        async with db_pool.acquire("get_profile") as db:
+            async with db.execute("SELECT name, age, interests, about, updated_at FROM profile WHERE user_id=?",
+                                  (user_id,)) as cur:
+                row = await cur.fetchone()
+        cached = {"name": row[0], "age": row[1], "interests": row[2], "about": row[3], "updated_at": row[4]} if row else {}
+        PROFILE_CACHE.set(user_id, cached, token)
+    # копия — чтобы вызывающий код не испортил кеш
+    return dict(cached) if cached else None
 
 async def set_profile(user_id: int, name=None, age=None, interests=None, about=None):
     prof = await get_profile(user_id) or {}
@@ -437,49 +1283,298 @@ async def set_profile(user_id: int, name=None, age=None, interests=None, about=N
     interests = prof.get("interests") if interests is None else interests
     about = prof.get("about") if about is None else about
     now = datetime.now().isoformat()
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            INSERT INTO profile (user_id, name, age, interests, about, updated_at)
-            VALUES (?, ?, ?, ?, ?, ?)
-            ON CONFLICT(user_id) DO UPDATE SET
-                name=excluded.name,
-                age=excluded.age,
-                interests=excluded.interests,
-                about=excluded.about,
-                updated_at=excluded.updated_at
-        """, (user_id, name, age, interests, about, now))
-        await db.commit()
+    await db_writer.execute("""
+        INSERT INTO profile (user_id, name, age, interests, about, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            name=excluded.name,
+            age=excluded.age,
+            interests=excluded.interests,
+            about=excluded.about,
+            updated_at=excluded.updated_at
+    """, (user_id, name, age, interests, about, now), op="set_profile")
+    PROFILE_CACHE.set(user_id, {"name": name, "age": age, "interests": interests, "about": about, "updated_at": now})
 
 async def forget_user(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM profile WHERE user_id=?", (user_id,))
-        await db.execute("DELETE FROM premium WHERE user_id=?", (user_id,))
-        await db.execute("DELETE FROM usage WHERE user_id=?", (user_id,))
-        await db.execute("DELETE FROM dialog WHERE user_id=?", (user_id,))
-        await db.execute("DELETE FROM users WHERE user_id=?", (user_id,))
-        await db.commit()
+    reset_pending_turns(user_id)
+    async with dialog_writer.user_lock(user_id), dialog_writer.lock:
+        dialog_writer.discard(user_id)
+        history_cache.drop(user_id)
+
+        async def job(db):
+            for table in ("profile", "premium", "usage", "dialog", "dialog_archive", "expiry_notices", "users"):
+                await db.execute(f"DELETE FROM {table} WHERE user_id=?", (user_id,))
+        await db_writer.run(job, op="forget_user")
+        await dialog_archiver.erase(user_id)
+    ACCESS_CACHE.pop(user_id)
+    PROFILE_CACHE.pop(user_id)
 
 # ---- диалог
+class DialogWriter:
+    """Групповая запись истории диалога.
+
+    Реплики копятся в памяти и раз в DIALOG_FLUSH_INTERVAL сек пишутся одной транзакцией
+    (один fsync на всех пользователей). Окно истории подрезается дешёвой отсечкой по
+    индексу dialog(user_id, id). Пока реплика не записана, get_history_messages видит её
+    из буфера (buffered). lock держится на время сброса и удалений истории; чтение истории
+    с диска берёт только user_lock своего пользователя, так что холодные промахи разных
+    пользователей идут параллельно и не ждут сброса.
+    """
+
+    def __init__(self, interval: float, keep: int):
+        self.interval = interval
+        self.keep = keep
+        self.lock = asyncio.Lock()
+        self._pending: list[tuple[int, str, str, str]] = []  # (user_id, role, content, ts)
+        # строки текущего сброса и id первой из них (известен, как только выполнен INSERT)
+        self._inflight: list[tuple[int, str, str, str]] = []
+        self._inflight_first_id: int | None = None
+        # user_id -> [lock, число держателей и ожидающих]; запись удаляется, когда lock никому не нужен
+        self._user_locks: dict[int, list] = {}
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        await self.flush()
+
+    def add(self, user_id: int, entries: list[tuple[str, str]]):
+        ts = datetime.now().isoformat()
+        self._pending.extend((user_id, role, content, ts) for role, content in entries)
+        self._wakeup.set()
+
+    @contextlib.asynccontextmanager
+    async def user_lock(self, user_id: int):
+        entry = self._user_locks.get(user_id)
+        if entry is None:
+            entry = self._user_locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._user_locks[user_id]
+
+    def buffered(self, user_id: int) -> list[tuple[int | None, str, str]]:
+        """Незаписанные реплики пользователя: (id или None, роль, текст).
+
+        id есть только у строк сброса, уже вставленных в транзакцию: такая строка могла
+        попасть в параллельное чтение с диска, и по id её дубль отсекается.
+        """
+        rows = []
+        for i, (uid, role, content, _) in enumerate(self._inflight):
+            if uid == user_id:
+                first_id = self._inflight_first_id
+                rows.append((first_id + i if first_id is not None else None, role, content))
+        rows.extend((None, role, content) for uid, role, content, _ in self._pending if uid == user_id)
+        return rows
+
+    def discard(self, user_id: int):
+        self._pending = [row for row in self._pending if row[0] != user_id]
+
+    async def flush(self):
+        async with self.lock:
+            rows, self._pending = self._pending, []
+            if not rows:
+                return
+            self._inflight, self._inflight_first_id = rows, None
+            try:
+                await db_writer.run(lambda db: self._write(db, rows), op="dialog_flush")
+            except Exception:
+                # вернём реплики в буфер — попробуем на следующем сбросе
+                logging.exception("Dialog flush failed (%s rows)", len(rows))
+                self._pending[:0] = rows
+            finally:
+                self._inflight, self._inflight_first_id = [], None
+
+    async def _write(self, db, rows):
+        await db.executemany(
+            "INSERT INTO dialog (user_id, role, content, ts) VALUES (?, ?, ?, ?)", rows
+        )
+        # внутри транзакции писатель один, поэтому id строк идут подряд и заканчиваются last_insert_rowid
+        async with db.execute("SELECT last_insert_rowid()") as cur:
+            self._inflight_first_id = (await cur.fetchone())[0] - len(rows) + 1
+        for user_id in {row[0] for row in rows}:
+            # id самой старой реплики, которая ещё входит в окно
+            async with db.execute(
+                "SELECT id FROM dialog WHERE user_id=? ORDER BY id DESC LIMIT 1 OFFSET ?",
+                (user_id, self.keep - 1)
+            ) as cur:
+                cutoff = await cur.fetchone()
+            if cutoff:
+                await db.execute("DELETE FROM dialog WHERE user_id=? AND id<?", (user_id, cutoff[0]))
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            # копим реплики от других пользователей, чтобы закоммитить их вместе
+            await asyncio.sleep(self.interval)
+            self._wakeup.clear()
+            await self.flush()
+
+dialog_writer = DialogWriter(DIALOG_FLUSH_INTERVAL, HISTORY_MAX_TURNS * 2)
+
+class HistoryCache:
+    """LRU последних реплик по user_id с потолком по памяти.
+
+    На промахе заполняется из БД (+ буфер DialogWriter), дальше поддерживается
+    add_dialog / clear_dialog / forget_user, так что сборка промпта для активного
+    пользователя не трогает диск. max_bytes <= 0 — кеш выключен, история всегда читается из БД.
+    """
+
+    ENTRY_OVERHEAD = 64  # кортеж + ссылки, грубо
+
+    def __init__(self, window: int, max_bytes: int):
+        self.window = window
+        self.max_bytes = max_bytes
+        self.enabled = max_bytes > 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        self._data: OrderedDict[int, deque] = OrderedDict()
+        self._sizes: dict[int, int] = {}
+        # порядковый номер первой реплики в deque: растёт, когда старые реплики вытесняются окном
+        self._first_seq: dict[int, int] = {}
+
+    @classmethod
+    def _entry_size(cls, entry: tuple[str, str]) -> int:
+        return sys.getsizeof(entry[1]) + cls.ENTRY_OVERHEAD
+
+    def get(self, user_id: int) -> list[tuple[str, str]] | None:
+        turns = self._data.get(user_id)
+        if turns is None:
+            self.misses += 1
+            HISTORY_CACHE_LOOKUPS.labels("miss").inc()
+            return None
+        self.hits += 1
+        HISTORY_CACHE_LOOKUPS.labels("hit").inc()
+        self._data.move_to_end(user_id)
+        return list(turns)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._data
+
+    def first_seq(self, user_id: int) -> int:
+        return self._first_seq.get(user_id, 0)
+
+    def put(self, user_id: int, entries: list[tuple[str, str]]):
+        if not self.enabled:
+            return
+        self.drop(user_id)
+        self._data[user_id] = deque(maxlen=self.window)
+        self._sizes[user_id] = 0
+        self._first_seq[user_id] = 0
+        self._extend(user_id, entries)
+
+    def append(self, user_id: int, entries: list[tuple[str, str]]):
+        # незакешированного пользователя не заводим: при промахе он загрузится целиком
+        if user_id in self._data:
+            self._data.move_to_end(user_id)
+            self._extend(user_id, entries)
+
+    def drop(self, user_id: int):
+        if self._data.pop(user_id, None) is not None:
+            self.bytes -= self._sizes.pop(user_id)
+            self._first_seq.pop(user_id, None)
+            HISTORY_CACHE_BYTES.set(self.bytes)
+
+    def _extend(self, user_id: int, entries: list[tuple[str, str]]):
+        turns = self._data[user_id]
+        delta = 0
+        for entry in entries:
+            if len(turns) == turns.maxlen:
+                delta -= self._entry_size(turns[0])
+                self._first_seq[user_id] += 1
+            turns.append(entry)
+            delta += self._entry_size(entry)
+        self._sizes[user_id] += delta
+        self.bytes += delta
+        HISTORY_CACHE_BYTES.set(self.bytes)
+        # вытесняем самых давно неактивных, но текущего пользователя оставляем
+        while self.bytes > self.max_bytes and len(self._data) > 1:
+            oldest = next(iter(self._data))
+            if oldest == user_id:
+                break
+            self.drop(oldest)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "users": len(self._data),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 3) if total else 0.0,
+        }
+
+history_cache = HistoryCache(HISTORY_MAX_TURNS * 2, int(HISTORY_CACHE_MAX_MB * 1024 * 1024))
+
 async def add_dialog(user_id: int, role: str, content: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("INSERT INTO dialog (user_id, role, content, ts) VALUES (?, ?, ?, ?)",
-                         (user_id, role, content, datetime.now().isoformat()))
-        await db.execute("""
-            DELETE FROM dialog
-            WHERE id NOT IN (
-                SELECT id FROM dialog WHERE user_id=? ORDER BY id DESC LIMIT ?
-            ) AND user_id=?
-        """, (user_id, HISTORY_MAX_TURNS * 2, user_id))
-        await db.commit()
+    dialog_writer.add(user_id, [(role, content)])
+    history_cache.append(user_id, [(role, content)])
+
+async def add_dialog_turn(user_id: int, user_text: str, reply: str):
+    # пара реплик попадает в один сброс, а значит и в одну транзакцию
+    entries = [("user", user_text), ("assistant", reply)]
+    dialog_writer.add(user_id, entries)
+    history_cache.append(user_id, entries)
+
+async def clear_dialog(user_id: int):
+    reset_pending_turns(user_id)
+    async with dialog_writer.user_lock(user_id), dialog_writer.lock:
+        dialog_writer.discard(user_id)
+        history_cache.drop(user_id)
+
+        async def job(db):
+            await db.execute("DELETE FROM dialog WHERE user_id=?", (user_id,))
+            # и архивную историю — иначе она вернётся при следующем сообщении
+            await db.execute("DELETE FROM dialog_archive WHERE user_id=?", (user_id,))
+        await db_writer.run(job, op="clear_dialog")
+        await dialog_archiver.erase(user_id)
 
 async def get_history_messages(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("""
-            SELECT role, content FROM dialog
-            WHERE user_id=?
-            ORDER BY id ASC
-        """, (user_id,)) as cur:
-            return await cur.fetchall()
+    _, rows = await get_history_window(user_id)
+    return rows
+
+async def get_history_window(user_id: int) -> tuple[int, list[tuple[str, str]]]:
+    """(порядковый номер первой реплики, реплики) — номер нужен для стабильной обрезки промпта."""
+    cached = history_cache.get(user_id)
+    if cached is not None:
+        return history_cache.first_seq(user_id), cached
+    # глобальный lock писателя не берём: промахи разных пользователей и сброс идут параллельно
+    async with dialog_writer.user_lock(user_id):
+        if user_id in history_cache:
+            # пока ждали lock, историю загрузил параллельный промах
+            return history_cache.first_seq(user_id), history_cache.get(user_id)
+        # пользователь вернулся после архивации — сначала достаём историю из архива
+        await dialog_archiver.restore(user_id)
+        async with db_pool.acquire("get_history_window") as db:
+            async with db.execute("""
+                SELECT id, role, content FROM dialog
+                WHERE user_id=?
+                ORDER BY id DESC
+                LIMIT ?
+            """, (user_id, history_cache.window)) as cur:
+                rows = await cur.fetchall()
+        # снимок буфера — после чтения и без await до put: свежие реплики не потеряются,
+        # а строки сброса, чей коммит чтение уже увидело (id не больше прочитанного), отсекаются
+        newest = rows[0][0] if rows else 0
+        rows = [(role, content) for _, role, content in reversed(rows)] + [
+            (role, content) for row_id, role, content in dialog_writer.buffered(user_id)
+            if row_id is None or row_id > newest
+        ]
+        history_cache.put(user_id, rows)
+        return history_cache.first_seq(user_id), rows[-history_cache.window:]
 
 # ========= PASSIVE PROFILE EXTRACTION =========
 RE_NAME = re.compile(r"\b(меня зовут|зови меня|я\s*—|я\s*-)\s*([A-Za-zА-Яа-яЁё\-]+)\b", re.IGNORECASE)
@@ -487,42 +1582,547 @@ RE_AGE = re.compile(r"\bмне\s+(\d{1,3})\b", re.IGNORECASE)
 RE_INTERESTS = re.compile(r"\b(я люблю|нравится|интересуюсь|мои интересы[:\-]?)\s+(.+)", re.IGNORECASE)
 
 async def try_extract_and_save_profile(user_id: int, text: str):
-    prof = await get_profile(user_id) or {}
-    updated = False
+    # сначала прогоняем все регулярки, потом — не больше одной записи в БД
+    changes = {}
 
     m = RE_NAME.search(text)
     if m:
-        name = m.group(2).strip().capitalize()
-        if not prof.get("name") or prof.get("name") != name:
-            await set_profile(user_id, name=name)
-            updated = True
+        changes["name"] = m.group(2).strip().capitalize()
 
     m = RE_AGE.search(text)
     if m:
         age = int(m.group(1))
-        if 5 <= age <= 120 and prof.get("age") != age:
-            await set_profile(user_id, age=age)
-            updated = True
+        if 5 <= age <= 120:
+            changes["age"] = age
 
     m = RE_INTERESTS.search(text)
     if m:
-        interests = m.group(2).strip()[:300]
-        if not prof.get("interests") or prof.get("interests") != interests:
-            await set_profile(user_id, interests=interests)
-            updated = True
+        changes["interests"] = m.group(2).strip()[:300]
 
-    return updated
+    if not changes:
+        return False
+    prof = await get_profile(user_id) or {}
+    changes = {k: v for k, v in changes.items() if prof.get(k) != v}
+    if not changes:
+        return False
+    await set_profile(user_id, **changes)
+    return True
+
+# ========= PROMPT =========
+MESSAGE_TOKEN_OVERHEAD = 4  # служебные токены роли/разметки на каждое сообщение
+
+def estimate_tokens(text: str) -> int:
+    """Быстрая оценка числа токенов: ~4 ASCII-символа или ~2 прочих (кириллица, эмодзи) на токен."""
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return ascii_chars // 4 + (len(text) - ascii_chars) // 2 + 1
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    tokens = estimate_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    keep = max(1, len(text) * max_tokens // tokens - 1)
+    return text[:keep].rstrip() + "…"
+
+def build_prompt(profile_text: str, history_rows: list, user_text: str, budget: int,
+                 first_seq: int = 0, plan: str = "trial") -> tuple[list[dict], int]:
+    """Собирает сообщения для модели в пределах budget токенов; возвращает (messages, оценка токенов).
+
+    Порядок рассчитан на кеш префиксов DeepSeek: сначала неизменный SYSTEM_PROMPT, затем
+    история (между ходами она только дописывается), и лишь в конце то, что меняется:
+    профиль и текущая реплика. first_seq — порядковый номер history_rows[0], по нему
+    начало истории выравнивается на блоки HISTORY_TRIM_BLOCK. Оценка попадает в гистограмму
+    sophia_prompt_tokens с меткой plan (trial / premium).
+    """
+    head = [{"role": "system", "content": SYSTEM_PROMPT}]
+    tail = [
+        {"role": "system", "content": f"[User Profile] {profile_text}"},
+        {"role": "user", "content": user_text},
+    ]
+    used = sum(estimate_tokens(msg["content"]) + MESSAGE_TOKEN_OVERHEAD for msg in head + tail)
+
+    # от новых реплик к старым, пока помещаются в бюджет
+    contents = [truncate_to_tokens(content, HISTORY_MSG_MAX_TOKENS) for _, content in history_rows]
+    costs = [estimate_tokens(content) + MESSAGE_TOKEN_OVERHEAD for content in contents]
+    start = len(history_rows)
+    while start > 0 and used + costs[start - 1] <= budget:
+        start -= 1
+        used += costs[start]
+
+    # выравниваем начало вверх до границы блока: оно сдвигается раз в несколько ходов, а не каждый ход
+    block = max(1, HISTORY_TRIM_BLOCK)
+    aligned = -(-(first_seq + start) // block) * block - first_seq
+    if start < aligned < len(history_rows):
+        used -= sum(costs[start:aligned])
+        start = aligned
+    history = [{"role": role, "content": content}
+               for (role, _), content in zip(history_rows[start:], contents[start:])]
+
+    PROMPT_TOKENS.labels(plan).observe(used)
+    return head + history + tail, used
 
 # ========= AI CALL =========
-async def ask_deepseek(messages: list[dict]) -> str:
-    url = "https://api.deepseek.com/chat/completions"
-    headers = {"Authorization": f"Bearer {DEEPSEEK_API_KEY}"}
-    payload = {"model": DEEPSEEK_MODEL, "messages": messages}
-    async with httpx.AsyncClient(timeout=40) as client:
-        r = await client.post(url, headers=headers, json=payload)
+# ---- провайдеры: OpenAI-совместимые API; у каждого свой клиент, соединения переиспользуются между ответами
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+class LLMProvider:
+    """Один OpenAI-совместимый бэкенд (URL, ключ, модель) со своей статистикой.
+
+    ewma — сглаженная задержка успешных ответов (для потока — до первого куска), по ней
+    провайдеры упорядочиваются. После LLM_PROVIDER_MAX_FAILS ошибок подряд провайдер уходит
+    в конец очереди на LLM_PROVIDER_COOLDOWN сек.
+    """
+
+    def __init__(self, name: str, url: str, api_key: str | None, model: str):
+        self.name = name
+        self.url = url.rstrip("/")
+        self.api_key = api_key
+        self.model = model
+        self.ewma: float | None = None
+        self.fails_in_row = 0
+        self.cooldown_until = 0.0
+        self.requests = 0
+        self.errors = 0
+        self._client: httpx.AsyncClient | None = None
+
+    @classmethod
+    def from_env(cls, name: str) -> "LLMProvider":
+        prefix = name.upper()
+        if prefix == "DEEPSEEK":
+            return cls("deepseek", DEEPSEEK_API_URL, DEEPSEEK_API_KEY, DEEPSEEK_MODEL)
+        url = os.getenv(f"{prefix}_API_URL")
+        if not url:
+            raise RuntimeError(f"LLM provider {name}: {prefix}_API_URL is not set")
+        return cls(name.lower(), url, os.getenv(f"{prefix}_API_KEY"), os.getenv(f"{prefix}_MODEL", DEEPSEEK_MODEL))
+
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            http2 = DEEPSEEK_HTTP2 and _http2_available()
+            self._client = httpx.AsyncClient(
+                base_url=self.url,
+                headers={"Authorization": f"Bearer {self.api_key}"},
+                timeout=httpx.Timeout(DEEPSEEK_READ_TIMEOUT, connect=DEEPSEEK_CONNECT_TIMEOUT),
+                limits=httpx.Limits(
+                    max_connections=DEEPSEEK_MAX_CONNECTIONS,
+                    max_keepalive_connections=DEEPSEEK_MAX_KEEPALIVE,
+                    keepalive_expiry=DEEPSEEK_KEEPALIVE_EXPIRY,
+                ),
+                http2=http2,
+            )
+            logging.info("LLM provider %s: HTTP client created (http2=%s)", self.name, http2)
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    @property
+    def cooling_down(self) -> bool:
+        return time.monotonic() < self.cooldown_until
+
+    def record_success(self, latency: float):
+        self.requests += 1
+        self.fails_in_row = 0
+        self.observe(latency)
+
+    def record_failure(self):
+        self.requests += 1
+        self.errors += 1
+        self.fails_in_row += 1
+        if self.fails_in_row >= LLM_PROVIDER_MAX_FAILS:
+            self.cooldown_until = time.monotonic() + LLM_PROVIDER_COOLDOWN
+            logging.warning("LLM provider %s: %s errors in a row, cooling down for %.0fs",
+                            self.name, self.fails_in_row, LLM_PROVIDER_COOLDOWN)
+
+    def observe(self, latency: float):
+        self.ewma = latency if self.ewma is None else self.ewma + LLM_EWMA_ALPHA * (latency - self.ewma)
+
+    def stats(self) -> dict:
+        return {
+            "model": self.model,
+            "ewma_ms": round(self.ewma * 1000, 1) if self.ewma is not None else None,
+            "requests": self.requests,
+            "errors": self.errors,
+            "cooling_down": self.cooling_down,
+        }
+
+LLM_PROVIDERS = [LLMProvider.from_env(name) for name in LLM_PROVIDER_NAMES]
+LLM_ROUTING = {"hedges": 0, "hedge_wins": 0, "failovers": 0}
+
+def ranked_providers() -> list[LLMProvider]:
+    """Сначала здоровые, среди них — с меньшей задержкой; без замеров — в порядке из LLM_PROVIDERS."""
+    order = {id(p): i for i, p in enumerate(LLM_PROVIDERS)}
+    return sorted(LLM_PROVIDERS, key=lambda p: (p.cooling_down,
+                                                p.ewma if p.ewma is not None else float("inf"),
+                                                order[id(p)]))
+
+def providers_stats() -> dict:
+    return {**LLM_ROUTING, "providers": {p.name: p.stats() for p in LLM_PROVIDERS}}
+
+async def start_http_client():
+    """Создаёт клиенты и заранее открывает соединения, чтобы первый ответ не платил за handshake."""
+    async def warm_up(provider: LLMProvider):
+        t0 = time.monotonic()
+        try:
+            r = await provider.client().get("/models")
+            logging.info("LLM provider %s warm-up: HTTP %s in %.0f ms",
+                         provider.name, r.status_code, (time.monotonic() - t0) * 1000)
+        except Exception as e:
+            # не критично: соединение откроется при первом запросе
+            logging.warning("LLM provider %s warm-up failed: %s", provider.name, e)
+    await asyncio.gather(*(warm_up(p) for p in LLM_PROVIDERS))
+
+async def close_http_client():
+    for provider in LLM_PROVIDERS:
+        await provider.close()
+
+# ---- планировщик: лимит одновременных запросов, приоритет премиума, повторы
+PRIORITY_PREMIUM = 0
+PRIORITY_TRIAL = 1
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+RETRY_TRANSPORT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError)
+
+class LLMQueueTimeout(Exception):
+    """Запрос к модели не дождался свободного слота за LLM_QUEUE_TIMEOUT."""
+
+class LLMScheduler:
+    """Допуск запросов к модели: не больше max_concurrency одновременно.
+
+    Лишние ждут в очереди с приоритетом (меньше — раньше; внутри приоритета — FIFO)
+    не дольше queue_timeout. Освободившийся слот сразу передаётся следующему в очереди.
+    """
+
+    def __init__(self, max_concurrency: int, queue_timeout: float):
+        self.max_concurrency = max(1, max_concurrency)
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self.admitted = 0
+        self.timed_out = 0
+        self.retries = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority: int = PRIORITY_TRIAL):
+        t0 = time.monotonic()
+        if self.in_flight < self.max_concurrency and not self.queue_depth:
+            self.in_flight += 1
+        else:
+            fut = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+            LLM_QUEUE_DEPTH.set(self.queue_depth)
+            try:
+                await asyncio.wait_for(fut, self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.timed_out += 1
+                raise LLMQueueTimeout(f"no LLM slot within {self.queue_timeout:g}s") from None
+            except asyncio.CancelledError:
+                # слот успели передать нам — вернём его следующему
+                if fut.done() and not fut.cancelled():
+                    self._release()
+                raise
+            finally:
+                LLM_QUEUE_DEPTH.set(self.queue_depth)
+        wait = time.monotonic() - t0
+        self.admitted += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _release(self):
+        while self._waiters:
+            _, _, fut = heapq.heappop(self._waiters)
+            if not fut.done():
+                fut.set_result(None)  # слот переходит ожидающему, in_flight не меняется
+                return
+        self.in_flight -= 1
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(1 for *_, fut in self._waiters if not fut.done())
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "admitted": self.admitted,
+            "timed_out": self.timed_out,
+            "retries": self.retries,
+            "wait_avg_ms": round(self.wait_total / self.admitted * 1000, 1) if self.admitted else 0.0,
+            "wait_max_ms": round(self.wait_max * 1000, 1),
+        }
+
+llm_scheduler = LLMScheduler(LLM_MAX_CONCURRENCY, LLM_QUEUE_TIMEOUT)
+
+# ---- учёт токенов и попаданий в кеш префиксов (поле usage в ответах DeepSeek)
+LLM_USAGE = {
+    "responses": 0,
+    "prompt_tokens": 0,
+    "completion_tokens": 0,
+    "cache_hit_tokens": 0,
+    "cache_miss_tokens": 0,
+}
+
+def record_usage(usage: dict | None):
+    if not usage:
+        return
+    hit = int(usage.get("prompt_cache_hit_tokens") or 0)
+    miss = int(usage.get("prompt_cache_miss_tokens") or 0)
+    LLM_USAGE["responses"] += 1
+    LLM_USAGE["prompt_tokens"] += int(usage.get("prompt_tokens") or 0)
+    LLM_USAGE["completion_tokens"] += int(usage.get("completion_tokens") or 0)
+    LLM_USAGE["cache_hit_tokens"] += hit
+    LLM_USAGE["cache_miss_tokens"] += miss
+    logging.info("DeepSeek usage: prompt=%s (cache hit %s / miss %s), completion=%s, cache hit ratio so far %.1f%%",
+                 usage.get("prompt_tokens"), hit, miss, usage.get("completion_tokens"), cache_hit_ratio() * 100)
+
+def cache_hit_ratio() -> float:
+    total = LLM_USAGE["cache_hit_tokens"] + LLM_USAGE["cache_miss_tokens"]
+    return LLM_USAGE["cache_hit_tokens"] / total if total else 0.0
+
+def _retry_delay(error: Exception, attempt: int) -> float | None:
+    """Пауза перед повтором (сек) или None, если повторять не нужно."""
+    if attempt >= LLM_MAX_RETRIES:
+        return None
+    retry_after = 0.0
+    if isinstance(error, httpx.HTTPStatusError):
+        if error.response.status_code not in RETRY_STATUSES:
+            return None
+        try:
+            retry_after = float(error.response.headers.get("Retry-After", 0))
+        except ValueError:
+            retry_after = 0.0  # HTTP-дата вместо секунд — обойдёмся бэкоффом
+    elif not isinstance(error, RETRY_TRANSPORT_ERRORS):
+        return None
+    backoff = min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt)
+    # джиттер, чтобы повторы разных пользователей не пришли одной пачкой
+    return max(retry_after, backoff) + random.uniform(0, backoff)
+
+async def _hedged(start, discard=None):
+    """Запускает start(provider) у лучшего провайдера и возвращает (provider, результат) первого успеха.
+
+    Если ответа нет дольше LLM_HEDGE_DELAY, тот же запрос параллельно уходит следующему провайдеру
+    (побеждает тот, кто ответит раньше); если попытка упала — следующий запускается сразу.
+    Проигравшие попытки отменяются; успевший результат проигравшего отдаётся в discard.
+    Если упали все — пробрасывается последняя ошибка.
+    """
+    candidates = ranked_providers()
+    tasks: dict[asyncio.Task, LLMProvider] = {}
+    primary = candidates[0]
+    last_error: Exception | None = None
+
+    def launch():
+        provider = candidates.pop(0)
+        tasks[asyncio.create_task(start(provider))] = provider
+
+    launch()
+    try:
+        while tasks:
+            hedge_after = LLM_HEDGE_DELAY if candidates and LLM_HEDGE_DELAY > 0 else None
+            done, _ = await asyncio.wait(tasks, timeout=hedge_after, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                LLM_ROUTING["hedges"] += 1
+                logging.info("LLM: no answer in %.1fs, hedging to %s", hedge_after, candidates[0].name)
+                launch()
+                continue
+            for task in done:
+                provider = tasks.pop(task)
+                try:
+                    result = task.result()
+                except (httpx.HTTPStatusError, httpx.TransportError) as e:
+                    last_error = e
+                    logging.warning("LLM provider %s failed: %s", provider.name, e)
+                    continue
+                if primary in tasks.values():
+                    # хедж обогнал основной запрос, который ещё в пути
+                    LLM_ROUTING["hedge_wins"] += 1
+                return provider, result
+            if not tasks and candidates:
+                LLM_ROUTING["failovers"] += 1
+                launch()
+        raise last_error
+    finally:
+        for task in tasks:
+            task.cancel()
+            task.add_done_callback(lambda t: _discard_result(t, discard))
+
+def _discard_result(task: asyncio.Task, discard):
+    if task.cancelled() or task.exception() is not None:
+        return
+    if discard is not None:
+        asyncio.create_task(discard(task.result()))
+
+async def _complete(provider: LLMProvider, payload: dict) -> dict:
+    started = time.perf_counter()
+    try:
+        r = await provider.client().post("/chat/completions", json={**payload, "model": provider.model})
+        r.raise_for_status()
+    except (httpx.HTTPStatusError, httpx.TransportError) as e:
+        provider.record_failure()
+        observe_llm("plain", provider.name, started, e)
+        raise
+    except asyncio.CancelledError:
+        # проигравший хедж: время до отмены — нижняя граница его задержки
+        provider.observe(max(time.perf_counter() - started, provider.ewma or 0.0))
+        raise
+    provider.record_success(time.perf_counter() - started)
+    observe_llm("plain", provider.name, started)
+    return r.json()
+
+async def ask_deepseek(messages: list[dict], priority: int = PRIORITY_TRIAL) -> str:
+    payload = {"messages": messages}
+    async with llm_scheduler.slot(priority):
+        for attempt in itertools.count():
+            try:
+                _, data = await _hedged(lambda provider: _complete(provider, payload))
+                break
+            except (httpx.HTTPStatusError, httpx.TransportError) as e:
+                delay = _retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                llm_scheduler.retries += 1
+                logging.warning("DeepSeek: %s, retry #%s in %.1fs", e, attempt + 1, delay)
+                await asyncio.sleep(delay)
+    record_usage(data.get("usage"))
+    return data["choices"][0]["message"]["content"].strip()
+
+def _sse_event(line: str):
+    """Разбирает строку SSE: None — пропустить, "[DONE]" — конец потока, иначе dict чанка."""
+    # пустые строки и keep-alive комментарии (": ...") пропускаем
+    if not line.startswith("data:"):
+        return None
+    data = line[5:].strip()
+    return data if data == "[DONE]" else json.loads(data)
+
+async def _open_stream(provider: LLMProvider, payload: dict):
+    """Открывает SSE-поток и ждёт первого события; возвращает (stack, lines, первое событие)."""
+    started = time.perf_counter()
+    stack = contextlib.AsyncExitStack()
+    try:
+        r = await stack.enter_async_context(
+            provider.client().stream("POST", "/chat/completions", json={**payload, "model": provider.model})
+        )
         r.raise_for_status()
-        data = r.json()
-        return data["choices"][0]["message"]["content"].strip()
+        lines = r.aiter_lines()
+        event = "[DONE]"
+        async for line in lines:
+            event = _sse_event(line)
+            if event is not None:
+                break
+    except BaseException as e:
+        await stack.aclose()
+        if isinstance(e, (httpx.HTTPStatusError, httpx.TransportError)):
+            provider.record_failure()
+            observe_llm("stream", provider.name, started, e)
+        elif isinstance(e, asyncio.CancelledError):
+            provider.observe(max(time.perf_counter() - started, provider.ewma or 0.0))
+        raise
+    provider.record_success(time.perf_counter() - started)
+    return stack, lines, event
+
+async def ask_deepseek_stream(messages: list[dict], priority: int = PRIORITY_TRIAL) -> AsyncIterator[str]:
+    """То же, что ask_deepseek, но с stream=true: отдаёт кусочки текста по мере генерации (SSE)."""
+    # include_usage: последний чанк придёт с usage (в том числе с попаданиями в кеш)
+    payload = {"messages": messages, "stream": True, "stream_options": {"include_usage": True}}
+
+    async def discard(opened):
+        await opened[0].aclose()
+
+    async with llm_scheduler.slot(priority):
+        # хеджирование и повторы — только до первого события: пользователю ещё ничего не показали
+        for attempt in itertools.count():
+            started = time.perf_counter()
+            try:
+                provider, (stack, lines, event) = await _hedged(
+                    lambda p: _open_stream(p, payload), discard
+                )
+                break
+            except (httpx.HTTPStatusError, httpx.TransportError) as e:
+                delay = _retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                llm_scheduler.retries += 1
+                logging.warning("DeepSeek stream: %s, retry #%s in %.1fs", e, attempt + 1, delay)
+                await asyncio.sleep(delay)
+
+        async with stack:
+            try:
+                while event != "[DONE]":
+                    if event is not None:
+                        record_usage(event.get("usage"))
+                        choices = event.get("choices") or []
+                        delta = (choices[0].get("delta") or {}).get("content") if choices else None
+                        if delta:
+                            yield delta
+                    line = await anext(lines, None)
+                    if line is None:
+                        break
+                    event = _sse_event(line)
+            except (httpx.HTTPStatusError, httpx.TransportError) as e:
+                observe_llm("stream", provider.name, started, e)
+                raise
+        observe_llm("stream", provider.name, started)
+
+async def _edit_streamed(sent: Message, text: str) -> bool:
+    """Правит потоковое сообщение; True — в чате теперь text.
+
+    Паузы по RetryAfter выдерживает FloodControlMiddleware; исключение доходит сюда,
+    только если он исчерпал повторы.
+    """
+    try:
+        await bot.edit_message_text(text, chat_id=sent.chat.id, message_id=sent.message_id)
+    except TelegramRetryAfter as e:
+        logging.warning("Stream edit dropped after flood-control retries: %s", e)
+        return False
+    except TelegramBadRequest as e:
+        # "message is not modified" и т.п. — не повод ронять ответ
+        logging.debug("Stream edit skipped: %s", e)
+    return True
+
+async def answer_streaming(m: Message, messages: list[dict], priority: int = PRIORITY_TRIAL) -> str:
+    """Отвечает пользователю по мере генерации и возвращает итоговый текст."""
+    text = ""
+    shown = ""
+    sent: Message | None = None
+    next_edit_at = 0.0
+    # промежуточная правка идёт в фоне (не больше одной сразу): пауза флуд-контроля не тормозит чтение потока
+    edit: asyncio.Task | None = None
+    edit_text = ""
+    async for delta in ask_deepseek_stream(messages, priority):
+        text += delta
+        if sent is None:
+            if not text.strip():
+                continue
+            sent = await m.answer(text, reply_markup=main_menu())
+            shown = text
+            next_edit_at = time.monotonic() + STREAM_EDIT_INTERVAL
+        elif time.monotonic() >= next_edit_at and (edit is None or edit.done()):
+            edit_text = text
+            edit = asyncio.create_task(_edit_streamed(sent, text))
+            next_edit_at = time.monotonic() + STREAM_EDIT_INTERVAL
+
+    reply = text.strip()
+    if edit is not None:
+        # финальная правка должна лечь после промежуточной
+        shown = edit_text if await edit else ""
+    if not reply:
+        raise ValueError("DeepSeek returned an empty completion")
+    if sent is None:
+        await m.answer(reply, reply_markup=main_menu())
+    elif reply != shown.strip():
+        await _edit_streamed(sent, reply)
+    return reply
 
 # ========= UI PIECES =========
 def buy_keyboard() -> InlineKeyboardMarkup:
@@ -541,17 +2141,8 @@ async def start(m: Message):
     user_id = m.from_user.id
     now = now_ts()
 
-    # trial_end_ts из users
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT COALESCE(trial_end_ts,0) FROM users WHERE user_id=?",
-            (user_id,)
-        )
-        row = await cur.fetchone()
-    trial_end = int(row[0]) if row and row[0] else 0
-
-    # premium_until (переводим TEXT → ts)
-    premium_until = await get_premium_until_ts(user_id)
+    # trial_end_ts и premium_until, обычно из кеша
+    trial_end, premium_until = await get_access_status(user_id)
 
     # 3) формируем строку статуса
     if now <= premium_until:
@@ -590,9 +2181,7 @@ async def cmd_profile(m: Message):
 @dp.message(Command("reset"))
 async def cmd_reset(m: Message):
     await ensure_user(m.from_user.id)
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM dialog WHERE user_id=?", (m.from_user.id,))
-        await db.commit()
+    await clear_dialog(m.from_user.id)
     await m.answer("Историю диалога очистила.", reply_markup=main_menu())
 
 @dp.message(Command("forget"))
@@ -600,28 +2189,368 @@ async def cmd_forget(m: Message):
     await forget_user(m.from_user.id)
     await m.answer("Я всё забыла: профиль, историю и лимиты. Можем начать заново.", reply_markup=main_menu())
 
-@dp.message(Command("export_feedback"))
-async def export_feedback(m: Message):
+# ---- выгрузка данных для админа
+# table -> (колонки, ключ для постраничного чтения, (колонка даты, "epoch"|"iso"), колонка kind)
+EXPORT_TABLES = {
+    "feedback": (("id", "user_id", "kind", "text", "created_at"), "id", ("created_at", "epoch"), "kind"),
+    "users": (("user_id", "created_at", "trial_start_ts", "trial_end_ts"), "user_id", ("created_at", "iso"), None),
+    "premium": (("user_id", "premium_until", "plan"), "user_id", ("premium_until", "epoch"), "plan"),
+    "dialog": (("id", "user_id", "role", "content", "ts"), "id", ("ts", "iso"), "role"),
+}
+EXPORT_USAGE = (
+    "Формат: /export <feedback|users|premium|dialog> [csv|jsonl] [from=ГГГГ-ММ-ДД] [to=ГГГГ-ММ-ДД] [kind=...]\n"
+    "kind — тип отзыва (feedback), план (premium) или роль (dialog)."
+)
+# одновременно идёт не больше одной выгрузки — чтобы не забить диск
+EXPORT_LOCK = asyncio.Lock()
+
+class ExportError(Exception):
+    """Выгрузку нельзя продолжать (место на диске, лимит размера); текст — для админа."""
+
+def _export_filters(table: str, date_from: str | None, date_to: str | None, kind: str | None):
+    _, _, (date_col, date_type), kind_col = EXPORT_TABLES[table]
+    where, params = [], []
+    for bound, op, shift in ((date_from, ">=", 0), (date_to, "<", 1)):
+        if not bound:
+            continue
+        # to — включительно: сравниваем с началом следующего дня
+        day = datetime.fromisoformat(bound) + timedelta(days=shift)
+        where.append(f"{date_col} {op} ?")
+        params.append(int(day.timestamp()) if date_type == "epoch" else day.date().isoformat())
+    if kind:
+        if kind_col is None:
+            raise ValueError(f"kind не поддерживается для {table}")
+        where.append(f"{kind_col} = ?")
+        params.append(kind)
+    return where, params
+
+async def export_table(table: str, fmt: str, path: str, date_from: str | None = None,
+                       date_to: str | None = None, kind: str | None = None) -> int:
+    """Пишет таблицу в gzip-файл path (CSV или JSONL) и возвращает число строк.
+
+    Строки читаются порциями по EXPORT_CHUNK_ROWS по ключу (keyset), соединение из пула берётся
+    только на время одной порции; сжатие и запись идут в отдельном потоке. Память — O(порции).
+    """
+    columns, key, _, _ = EXPORT_TABLES[table]
+    where, params = _export_filters(table, date_from, date_to, kind)
+    sql = (f"SELECT {', '.join(columns)} FROM {table} WHERE {' AND '.join([f'{key} > ?', *where])} "
+           f"ORDER BY {key} LIMIT ?")
+    key_index = columns.index(key)
+    max_bytes = EXPORT_MAX_MB * 1024 * 1024
+    min_free = EXPORT_MIN_FREE_MB * 1024 * 1024
+
+    f = gzip.open(path, "wt", encoding="utf-8", newline="")
+    try:
+        writer = csv.writer(f) if fmt == "csv" else None
+
+        def write_chunk(rows):
+            if writer is not None:
+                writer.writerows(rows)
+            else:
+                f.writelines(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n" for row in rows)
+            f.flush()
+            if os.path.getsize(path) > max_bytes:
+                raise ExportError(f"Файл больше {EXPORT_MAX_MB} МБ — сузьте период или фильтр.")
+            if shutil.disk_usage(os.path.dirname(path)).free < min_free:
+                raise ExportError("Мало места на диске — выгрузка остановлена.")
+
+        if writer is not None:
+            await asyncio.to_thread(writer.writerow, columns)
+        total, last_key = 0, -1 << 63
+        while True:
+            async with db_pool.acquire("export") as db:
+                async with db.execute(sql, (last_key, *params, EXPORT_CHUNK_ROWS)) as cur:
+                    rows = await cur.fetchall()
+            if not rows:
+                break
+            await asyncio.to_thread(write_chunk, rows)
+            total += len(rows)
+            last_key = rows[-1][key_index]
+            if len(rows) < EXPORT_CHUNK_ROWS:
+                break
+    finally:
+        await asyncio.to_thread(f.close)
+    return total
+
+@dp.message(Command("export", "export_feedback"))
+async def cmd_export(m: Message):
     # только админ
     if m.from_user.id != ADMIN_ID:
         return
 
-    rows = []
-    async with aiosqlite.connect(DB_PATH) as db:
+    args = m.text.split()
+    command, args = args[0], args[1:]
+    table = "feedback" if command.startswith("/export_feedback") else None
+    fmt, options = "csv", {}
+    for arg in args:
+        if arg in EXPORT_TABLES:
+            table = arg
+        elif arg in ("csv", "jsonl"):
+            fmt = arg
+        elif "=" in arg and arg.split("=", 1)[0] in ("from", "to", "kind"):
+            name, value = arg.split("=", 1)
+            options[name] = value
+        else:
+            return await m.answer(EXPORT_USAGE)
+    if table is None:
+        return await m.answer(EXPORT_USAGE)
+    try:
+        _export_filters(table, options.get("from"), options.get("to"), options.get("kind"))
+    except ValueError as e:
+        return await m.answer(f"{e}\n\n{EXPORT_USAGE}")
+    if EXPORT_LOCK.locked():
+        return await m.answer("Другая выгрузка ещё идёт — попробуйте чуть позже.")
+
+    async with EXPORT_LOCK:
+        fd, path = tempfile.mkstemp(prefix=f"export-{table}-", suffix=f".{fmt}.gz")
+        os.close(fd)
+        try:
+            t0 = time.monotonic()
+            total = await export_table(table, fmt, path, options.get("from"), options.get("to"), options.get("kind"))
+            logging.info("Export %s (%s, %s): %s rows, %.0f KiB in %.1fs", table, fmt, options, total,
+                         os.path.getsize(path) / 1024, time.monotonic() - t0)
+            filename = f"{table}-{datetime.now():%Y%m%d-%H%M}.{fmt}.gz"
+            await m.answer_document(FSInputFile(path, filename=filename),
+                                    caption=f"{table}: {total} строк ({fmt.upper()}, gzip)")
+        except ExportError as e:
+            await m.answer(str(e))
+        finally:
+            os.remove(path)
+
+# ---- рассылка от админа
+BROADCAST_TASK: asyncio.Task | None = None
+# кто держит аренду рассылки: имя хоста, pid и случайный суффикс (pid в контейнере может повториться)
+BROADCAST_OWNER = f"{os.uname().nodename}:{os.getpid()}:{random.getrandbits(32):08x}"
+
+class BroadcastLeaseLost(Exception):
+    """Аренду рассылки забрал другой процесс или рассылку отменили."""
+
+async def _broadcast_send(user_id: int, text: str) -> str:
+    """Одно сообщение рассылки; возвращает "sent" | "blocked" | "failed".
+
+    RetryAfter сюда доходит, только если FloodControlMiddleware исчерпал повторы (он же ставит
+    на паузу общий бакет — и остальные отправки рассылки ждут вместе с этой).
+    """
+    try:
+        await bot.send_message(user_id, text)
+        return "sent"
+    except TelegramForbiddenError:
+        return "blocked"  # бот заблокирован или аккаунт удалён
+    except Exception as e:
+        logging.warning("Broadcast to %s failed: %s", user_id, e)
+        return "failed"
+
+async def _claim_broadcast(broadcast_id: int) -> bool:
+    """Забирает аренду рассылки, если она свободна или истекла; True — рассылку ведёт этот процесс."""
+    now = now_ts()
+    rowcount = await db_writer.execute("""
+        UPDATE broadcasts SET owner=?, lease_until=?
+        WHERE id=? AND status='running' AND (owner IS NULL OR owner=? OR lease_until<?)
+    """, (BROADCAST_OWNER, now + BROADCAST_LEASE_SEC, broadcast_id, BROADCAST_OWNER, now),
+        op="broadcast_claim")
+    return rowcount == 1
+
+async def _broadcast_checkpoint(broadcast_id: int, last_user_id: int, counts: dict,
+                                status: str = "running", release: bool = False) -> bool:
+    """Сохраняет прогресс и продлевает аренду. False — аренды у нас больше нет или рассылку отменили."""
+    rowcount = await db_writer.execute("""
+        UPDATE broadcasts SET last_user_id=?, sent=?, failed=?, blocked=?, status=?,
+            finished_at=CASE WHEN ?='running' THEN NULL ELSE ? END,
+            owner=CASE WHEN ? THEN NULL ELSE owner END, lease_until=?
+        WHERE id=? AND owner=? AND status='running'
+    """, (last_user_id, counts["sent"], counts["failed"], counts["blocked"], status,
+          status, now_ts(), release, 0 if release else now_ts() + BROADCAST_LEASE_SEC,
+          broadcast_id, BROADCAST_OWNER), op="broadcast_checkpoint")
+    return rowcount == 1
+
+async def run_broadcast(broadcast_id: int):
+    """Рассылает сообщение всем пользователям, продолжая с сохранённой отметки.
+
+    Получатели читаются страницами по user_id (keyset), отправка идёт параллельно, но не быстрее
+    BROADCAST_RATE сообщений в секунду. Отметка (user_id, до которого всё отправлено) и счётчики
+    сохраняются раз в BROADCAST_CHECKPOINT_SEC сек — после рестарта повторно получат сообщение
+    максимум те, кто попал в последние секунды перед остановкой.
+
+    Рассылку ведёт только владелец аренды (broadcasts.owner). Остальные процессы ждут: если
+    владелец умрёт, аренда истечёт, и её заберёт один из них. Отметка пишется только при живой
+    аренде, так что процесс, потерявший её, прогресс нового владельца не затрёт.
+    """
+    while not await _claim_broadcast(broadcast_id):
+        async with db_pool.acquire("broadcast_lease") as db:
+            async with db.execute("SELECT status, lease_until FROM broadcasts WHERE id=?", (broadcast_id,)) as cur:
+                row = await cur.fetchone()
+        if row is None or row[0] != "running":
+            return
+        # рассылку ведёт другой процесс — проверим снова, когда истечёт его аренда
+        await asyncio.sleep(max(1, row[1] - now_ts() + 1))
+
+    async with db_pool.acquire("broadcast_load") as db:
         async with db.execute(
-            "SELECT id, user_id, kind, text, created_at FROM feedback ORDER BY id DESC LIMIT 1000"
+            "SELECT text, last_user_id, sent, failed, blocked FROM broadcasts WHERE id=?", (broadcast_id,)
         ) as cur:
-            async for r in cur:
-                rows.append(r)
+            text, watermark, *totals = await cur.fetchone()
+    counts = dict(zip(("sent", "failed", "blocked"), totals))
+    bucket = TokenBucket(BROADCAST_RATE, BROADCAST_RATE)
+    inflight: deque[tuple[int, asyncio.Task]] = deque()
+    next_checkpoint = time.monotonic() + BROADCAST_CHECKPOINT_SEC
+    last_user_id = watermark
+    lease_lost = False
+    logging.info("Broadcast #%s: starting after user %s", broadcast_id, watermark)
+
+    def collect():
+        # отметка двигается только по непрерывному префиксу завершённых отправок
+        nonlocal watermark
+        while inflight and inflight[0][1].done() and not inflight[0][1].cancelled():
+            user_id, task = inflight.popleft()
+            counts[task.result()] += 1
+            watermark = user_id
+
+    async def keep_lease(main: asyncio.Task):
+        # отметки в цикле идут только между отправками; при долгой паузе (RetryAfter) аренду продлевает этот таймер
+        nonlocal lease_lost
+        while True:
+            await asyncio.sleep(BROADCAST_LEASE_SEC / 3)
+            if not await _broadcast_checkpoint(broadcast_id, watermark, counts):
+                lease_lost = True
+                main.cancel()
+                return
+
+    heartbeat = asyncio.create_task(keep_lease(asyncio.current_task()))
+    try:
+        while True:
+            async with db_pool.acquire("broadcast_page") as db:
+                async with db.execute(
+                    "SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?",
+                    (last_user_id, BROADCAST_PAGE)
+                ) as cur:
+                    page = [row[0] for row in await cur.fetchall()]
+            for user_id in page:
+                # не больше секунды отправок в полёте: ограничивает и память, и повторы после рестарта
+                while len(inflight) >= max(1, int(BROADCAST_RATE)):
+                    await asyncio.wait([inflight[0][1]])
+                    collect()
+                await bucket.acquire()
+                inflight.append((user_id, asyncio.create_task(_broadcast_send(user_id, text))))
+                collect()
+                if time.monotonic() >= next_checkpoint:
+                    if not await _broadcast_checkpoint(broadcast_id, watermark, counts):
+                        raise BroadcastLeaseLost
+                    next_checkpoint = time.monotonic() + BROADCAST_CHECKPOINT_SEC
+            if page:
+                last_user_id = page[-1]
+            if len(page) < BROADCAST_PAGE:
+                break
+        if inflight:
+            await asyncio.wait([task for _, task in inflight])
+        collect()
+    except (asyncio.CancelledError, BroadcastLeaseLost) as e:
+        # остановка процесса: незавершённые отправки бросаем, отметку сохраняем и отпускаем аренду —
+        # рассылку сразу сможет продолжить другой процесс или этот после рестарта
+        heartbeat.cancel()
+        for _, task in inflight:
+            task.cancel()
+        await asyncio.gather(*(task for _, task in inflight), return_exceptions=True)
+        collect()
+        if lease_lost or isinstance(e, BroadcastLeaseLost):
+            logging.warning("Broadcast #%s: lease lost or broadcast cancelled, stopping at user %s",
+                            broadcast_id, watermark)
+            return
+        await _broadcast_checkpoint(broadcast_id, watermark, counts, release=True)
+        logging.info("Broadcast #%s: paused at user %s (%s)", broadcast_id, watermark, counts)
+        raise
+    finally:
+        heartbeat.cancel()
+
+    if not await _broadcast_checkpoint(broadcast_id, watermark, counts, status="done", release=True):
+        logging.warning("Broadcast #%s: lease lost before completion was recorded", broadcast_id)
+        return
+    logging.info("Broadcast #%s: done (%s)", broadcast_id, counts)
+    if ADMIN_ID:
+        with contextlib.suppress(Exception):
+            await bot.send_message(
+                ADMIN_ID,
+                f"Рассылка #{broadcast_id} завершена: отправлено {counts['sent']}, "
+                f"заблокировали бота {counts['blocked']}, ошибок {counts['failed']}."
+            )
 
-    # пишем во временный CSV и отправляем
-    with tempfile.NamedTemporaryFile("w", newline="", delete=False, suffix=".csv") as f:
-        writer = csv.writer(f)
-        writer.writerow(["id", "user_id", "kind", "text", "created_at"])
-        writer.writerows(rows)
-        path = f.name
+def _spawn_broadcast(broadcast_id: int):
+    global BROADCAST_TASK
+    BROADCAST_TASK = asyncio.create_task(run_broadcast(broadcast_id))
 
-    await m.answer_document(FSInputFile(path), caption="Отзывы/жалобы (CSV)")
+async def resume_broadcasts():
+    """При старте продолжает рассылку, прерванную рестартом или деплоем (или ждёт её, если ведёт другой процесс)."""
+    async with db_pool.acquire("broadcast_resume") as db:
+        async with db.execute("SELECT id FROM broadcasts WHERE status='running' ORDER BY id LIMIT 1") as cur:
+            row = await cur.fetchone()
+    if row:
+        _spawn_broadcast(row[0])
+
+async def stop_broadcasts():
+    global BROADCAST_TASK
+    task, BROADCAST_TASK = BROADCAST_TASK, None
+    if task is not None and not task.done():
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+
+@dp.message(Command("broadcast"))
+async def cmd_broadcast(m: Message):
+    # только админ
+    if m.from_user.id != ADMIN_ID:
+        return
+    parts = m.text.split(maxsplit=1)
+    text = parts[1].strip() if len(parts) > 1 else ""
+    if not text:
+        return await m.answer("Формат: /broadcast <текст сообщения>\n"
+                              "/broadcast_status — ход рассылки, /broadcast_cancel — остановить.")
+
+    async def job(db):
+        # проверка и вставка одной задачей писателя: две рассылки не запустить и из разных процессов
+        async with db.execute("""
+            INSERT INTO broadcasts(text, status, created_at, owner, lease_until)
+            SELECT ?, 'running', ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM broadcasts WHERE status='running')
+            RETURNING id
+        """, (text, now_ts(), BROADCAST_OWNER, now_ts() + BROADCAST_LEASE_SEC)) as cur:
+            row = await cur.fetchone()
+            return row[0] if row else None
+    broadcast_id = await db_writer.run(job, op="broadcast_create")
+    if broadcast_id is None:
+        return await m.answer("Рассылка уже идёт — /broadcast_status покажет прогресс.")
+    async with db_pool.acquire("broadcast_create") as db:
+        async with db.execute("SELECT COUNT(*) FROM users") as cur:
+            total = (await cur.fetchone())[0]
+    _spawn_broadcast(broadcast_id)
+    await m.answer(f"Рассылка #{broadcast_id} запущена: {total} получателей, "
+                   f"~{max(1, round(total / BROADCAST_RATE / 60))} мин.")
+
+@dp.message(Command("broadcast_status"))
+async def cmd_broadcast_status(m: Message):
+    if m.from_user.id != ADMIN_ID:
+        return
+    async with db_pool.acquire("broadcast_status") as db:
+        async with db.execute(
+            "SELECT id, status, last_user_id, sent, failed, blocked FROM broadcasts ORDER BY id DESC LIMIT 1"
+        ) as cur:
+            row = await cur.fetchone()
+        if not row:
+            return await m.answer("Рассылок ещё не было.")
+        async with db.execute("SELECT COUNT(*) FROM users WHERE user_id > ?", (row[2],)) as cur:
+            left = (await cur.fetchone())[0]
+    broadcast_id, status, _, sent, failed, blocked = row
+    await m.answer(f"Рассылка #{broadcast_id}: {status}\n"
+                   f"Отправлено: {sent}, заблокировали бота: {blocked}, ошибок: {failed}\n"
+                   f"Осталось (на последней отметке): {left}")
+
+@dp.message(Command("broadcast_cancel"))
+async def cmd_broadcast_cancel(m: Message):
+    if m.from_user.id != ADMIN_ID:
+        return
+    await stop_broadcasts()
+    rowcount = await db_writer.execute(
+        "UPDATE broadcasts SET status='cancelled', finished_at=? WHERE status='running'", (now_ts(),),
+        op="broadcast_cancel"
+    )
+    await m.answer("Рассылка остановлена." if rowcount else "Активной рассылки нет.")
 
 # ========= MENU (ReplyKeyboard) =========
 @dp.message(F.text == "💜 Профиль")
@@ -648,21 +2577,14 @@ async def menu_subscription(m: Message):
 
     now = now_ts()
 
-    # забираем конец триала из users
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT COALESCE(trial_end_ts,0) FROM users WHERE user_id=?",
-            (user_id,)
-        )
-        row = await cur.fetchone()
-    trial_end = int(row[0]) if row and row[0] else 0
+    # конец триала и конец премиума, обычно из кеша
+    trial_end, premium_until = await get_access_status(user_id)
 
-    # конец премиума (TEXT → ts) и план (month/week/None)
-    premium_until = await get_premium_until_ts(user_id)
+    # план (month/week/None)
     plan = ""
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT plan FROM premium WHERE user_id=?", (user_id,))
-        r = await cur.fetchone()
+    async with db_pool.acquire("menu_subscription") as db:
+        async with db.execute("SELECT plan FROM premium WHERE user_id=?", (user_id,)) as cur:
+            r = await cur.fetchone()
         plan = (r[0] or "") if r else ""
 
     # статусный текст
@@ -727,12 +2649,10 @@ async def feedback_save(m: Message, state: FSMContext):
     now = now_ts()
 
     # 1) сохранить в БД (таблица feedback уже создана в init_db)
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT INTO feedback(user_id, kind, text, created_at) VALUES(?,?,?,?)",
-            (m.from_user.id, kind, text, now)
-        )
-        await db.commit()
+    await db_writer.execute(
+        "INSERT INTO feedback(user_id, kind, text, created_at) VALUES(?,?,?,?)",
+        (m.from_user.id, kind, text, now), op="feedback_save"
+    )
 
     # 2) уведомить админа (если ADMIN_ID задан и ты писал боту ранее)
     if ADMIN_ID:
@@ -754,20 +2674,20 @@ async def feedback_save(m: Message, state: FSMContext):
 
 # ========= INLINE EDIT CALLBACKS (без слэш-команд) =========
 @dp.callback_query(F.data == "edit_name")
-async def cb_edit_name(c: CallbackQuery):
-    PENDING_EDIT[c.from_user.id] = "name"
+async def cb_edit_name(c: CallbackQuery, state: FSMContext):
+    await state.set_state(ProfileEdit.name)
     await c.message.answer("Окей, напиши новое имя одним сообщением 🙂")
     await c.answer()
 
 @dp.callback_query(F.data == "edit_age")
-async def cb_edit_age(c: CallbackQuery):
-    PENDING_EDIT[c.from_user.id] = "age"
+async def cb_edit_age(c: CallbackQuery, state: FSMContext):
+    await state.set_state(ProfileEdit.age)
     await c.message.answer("Хорошо, напиши возраст числом (например, 25).")
     await c.answer()
 
 @dp.callback_query(F.data == "edit_interests")
-async def cb_edit_interests(c: CallbackQuery):
-    PENDING_EDIT[c.from_user.id] = "interests"
+async def cb_edit_interests(c: CallbackQuery, state: FSMContext):
+    await state.set_state(ProfileEdit.interests)
     await c.message.answer("Отлично! Напиши через запятую твои интересы (например: бег, музыка, кино).")
     await c.answer()
 
@@ -857,8 +2777,7 @@ async def on_success_payment(m: Message):
         # Определим план из payload
         plan = "month" if "premium_month_" in sp.invoice_payload else "week"
         days = PREMIUM_DAYS_MONTH if plan == "month" else PREMIUM_DAYS_WEEK
-        await grant_premium(m.from_user.id, days, plan)
-        until = datetime.now() + timedelta(days=days)
+        until = datetime.fromtimestamp(await grant_premium(m.from_user.id, days, plan))
         await m.answer(
             f"Спасибо! 💎 Премиум ({'Месячная' if plan=='month' else 'Недельная'}) активирован до {until.strftime('%d.%m.%Y')}.\n"
             f"Теперь можно общаться без ограничений 💜",
@@ -903,8 +2822,9 @@ async def on_text(m: Message, state: FSMContext):
         return await m.answer("Напиши текстом, пожалуйста 🙂", reply_markup=main_menu())
 
     # 0) если ждём ответ для редактирования профиля — обработать и выйти (всегда разрешено)
-    if user_id in PENDING_EDIT:
-        field = PENDING_EDIT.pop(user_id)
+    field = PROFILE_EDIT_FIELDS.get(await state.get_state())
+    if field:
+        await state.clear()
         if field == "name":
             name = user_text.strip()
             if not re.match(r"^[A-Za-zА-Яа-яЁё\-\s]{1,40}$", name):
@@ -945,25 +2865,89 @@ async def on_text(m: Message, state: FSMContext):
     # 3) Пассивно дополняем профиль из обычной речи (не мешает диалогу)
     await try_extract_and_save_profile(user_id, user_text)
 
-    # 4) Готовим контекст для модели
+    # 4) Ответ готовится в фоне: несколько сообщений подряд склеятся в одну реплику
+    submit_user_text(m, user_id, user_text)
+
+# ========= COALESCING =========
+# user_id -> сообщения, ещё не отправленные в модель: [(Message, текст), ...]
+PENDING_TURNS: Dict[int, list[tuple[Message, str]]] = {}
+# user_id -> фоновая задача, которая отвечает этому пользователю (не больше одной)
+TURN_TASKS: Dict[int, asyncio.Task] = {}
+# user_id -> поколение диалога: растёт при сбросе и «забыть всё». Ответ, начатый
+# в старом поколении, пользователю уходит, но в историю уже не записывается.
+# Нужно только пока есть задача в TURN_TASKS — вместе с ней запись и удаляется
+DIALOG_GENERATION: Dict[int, int] = {}
+
+def reset_pending_turns(user_id: int):
+    """Вызывается перед стиранием истории: несклеенные сообщения выбрасываются, начатый ответ не сохранится."""
+    PENDING_TURNS.pop(user_id, None)
+    if user_id in TURN_TASKS:
+        DIALOG_GENERATION[user_id] = DIALOG_GENERATION.get(user_id, 0) + 1
+
+def submit_user_text(m: Message, user_id: int, user_text: str):
+    PENDING_TURNS.setdefault(user_id, []).append((m, user_text))
+    if user_id not in TURN_TASKS:
+        TURN_TASKS[user_id] = asyncio.create_task(_answer_user_turns(user_id))
+
+async def _answer_user_turns(user_id: int):
+    try:
+        # окно склейки: ждём, не допишет ли пользователь ещё
+        await asyncio.sleep(COALESCE_WINDOW_MS / 1000)
+        # всё, что пришло, пока генерировался ответ, — следующая склеенная реплика
+        while PENDING_TURNS.get(user_id):
+            batch = PENDING_TURNS.pop(user_id)
+            m = batch[-1][0]
+            user_text = "\n".join(text for _, text in batch)
+            # on_text только ставит реплику в очередь, поэтому сам ответ меряем отдельной меткой
+            started = time.perf_counter()
+            try:
+                await reply_to_turn(m, user_id, user_text, DIALOG_GENERATION.get(user_id, 0))
+            except Exception as e:
+                UPDATE_ERRORS.labels("reply_to_turn", error_class(e)).inc()
+                raise
+            finally:
+                UPDATE_SECONDS.labels("reply_to_turn").observe(time.perf_counter() - started)
+    except Exception:
+        logging.exception("Reply to user %s failed", user_id)
+    finally:
+        TURN_TASKS.pop(user_id, None)
+        DIALOG_GENERATION.pop(user_id, None)
+
+async def wait_pending_turns(timeout: float):
+    """При остановке даём дописать уже начатые ответы."""
+    if TURN_TASKS:
+        await asyncio.wait(list(TURN_TASKS.values()), timeout=timeout)
+
+async def reply_to_turn(m: Message, user_id: int, user_text: str, generation: int = 0):
+    # при очереди к модели премиум-пользователи идут первыми, и бюджет промпта у них свой
+    _, premium_until = await get_access_status(user_id)
+    is_premium = now_ts() <= premium_until
+    priority = PRIORITY_PREMIUM if is_premium else PRIORITY_TRIAL
+    budget = PROMPT_TOKEN_BUDGET_PREMIUM if is_premium else PROMPT_TOKEN_BUDGET
+
+    # 1) Готовим контекст для модели: размер промпта ограничен токенами, а не числом реплик
     profile = await get_profile(user_id)
     profile_text = profile_to_text(profile)
-    history_rows = await get_history_messages(user_id)
-
-    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
-    messages.append({"role": "system", "content": f"[User Profile] {profile_text}"})
-    for role, content in history_rows[-HISTORY_MAX_TURNS * 2:]:
-        messages.append({"role": role, "content": content})
-    messages.append({"role": "user", "content": user_text})
+    first_seq, history_rows = await get_history_window(user_id)
+    messages, prompt_tokens = build_prompt(profile_text, history_rows, user_text, budget, first_seq,
+                                           "premium" if is_premium else "trial")
+    logging.info("Prompt for user %s: ~%s tokens, %s history message(s)",
+                 user_id, prompt_tokens, len(messages) - 3)
 
     try:
         await bot.send_chat_action(m.chat.id, "typing")
     except Exception:
         pass
 
-    # 5) Вызов модели
+    # 2) Вызов модели (в потоковом режиме ответ уходит пользователю прямо по ходу генерации)
     try:
-        reply = await ask_deepseek(messages)
+        if STREAM_REPLIES:
+            reply = await answer_streaming(m, messages, priority)
+        else:
+            reply = await ask_deepseek(messages, priority)
+    except LLMQueueTimeout as e:
+        logging.warning("DeepSeek queue timeout for user %s: %s", user_id, e)
+        return await m.answer("Сейчас очень много разговоров одновременно. Напиши мне ещё раз чуть позже 💜", reply_markup=main_menu())
     except httpx.HTTPStatusError as e:
         logging.exception("DeepSeek HTTP error: %s", e)
         return await m.answer("Не получается ответить (ошибка сервера). Попробуем ещё раз?", reply_markup=main_menu())
@@ -971,17 +2955,387 @@ async def on_text(m: Message, state: FSMContext):
         logging.exception("DeepSeek error: %s", e)
         return await m.answer("У меня затык. Давай попробуем ещё раз через минуту.", reply_markup=main_menu())
 
-    # 6) Ответ пользователю
-    await m.answer(reply, reply_markup=main_menu())
+    # 3) Ответ пользователю
+    if not STREAM_REPLIES:
+        await m.answer(reply, reply_markup=main_menu())
 
-    # 7) История диалога
-    await add_dialog(user_id, "user", user_text)
-    await add_dialog(user_id, "assistant", reply)
+    # 4) История диалога: склеенные сообщения — одна реплика пользователя.
+    # Если пока готовился ответ, диалог сбросили или стёрли, — реплику не сохраняем
+    if DIALOG_GENERATION.get(user_id, 0) != generation:
+        logging.info("Dialog of user %s was reset during the reply, turn not saved", user_id)
+        return
+    await add_dialog_turn(user_id, user_text, reply)
+
+# ========= EXPIRY REMINDERS =========
+# kind -> запрос окна истекающих доступов. Оба идут диапазоном по индексу
+# (idx_users_trial_end / idx_premium_until) с keyset-страницами по (срок, user_id);
+# уже напомненные отсекаются по первичному ключу expiry_notices
+EXPIRY_QUERIES = {
+    "trial": """
+        SELECT u.user_id, u.trial_end_ts FROM users u
+        WHERE u.trial_end_ts > ? AND u.trial_end_ts <= ?
+          AND (u.trial_end_ts, u.user_id) > (?, ?)
+          AND NOT EXISTS (SELECT 1 FROM expiry_notices n
+                          WHERE n.user_id=u.user_id AND n.kind='trial' AND n.expires_at=u.trial_end_ts)
+          -- премиум дольше триала — напоминать про триал незачем
+          AND NOT EXISTS (SELECT 1 FROM premium p
+                          WHERE p.user_id=u.user_id AND p.premium_until > u.trial_end_ts)
+        ORDER BY u.trial_end_ts, u.user_id LIMIT ?
+    """,
+    "premium": """
+        SELECT p.user_id, p.premium_until FROM premium p
+        WHERE p.premium_until > ? AND p.premium_until <= ?
+          AND (p.premium_until, p.user_id) > (?, ?)
+          AND NOT EXISTS (SELECT 1 FROM expiry_notices n
+                          WHERE n.user_id=p.user_id AND n.kind='premium' AND n.expires_at=p.premium_until)
+        ORDER BY p.premium_until, p.user_id LIMIT ?
+    """,
+}
+
+def expiry_notice_text(kind: str, expires_at: int) -> str:
+    when = datetime.fromtimestamp(expires_at).strftime("%d.%m.%Y %H:%M")
+    if kind == "trial":
+        return (f"Бесплатный период заканчивается {when} 🕊\n"
+                "Чтобы мы могли и дальше общаться без перерыва, можно оформить подписку заранее 💜")
+    return (f"Твоя подписка заканчивается {when} 💎\n"
+            "Продли её, чтобы наш разговор не прерывался 💜")
+
+class ExpiryNotifier:
+    """Фоновые напоминания о скором окончании триала и премиума.
+
+    Раз в EXPIRY_SCAN_INTERVAL сек берёт тех, у кого доступ кончается в ближайшие
+    EXPIRY_NOTICE_WINDOW сек, порциями по EXPIRY_BATCH. Порция сначала «застолбляется» в
+    expiry_notices одной транзакцией (INSERT OR IGNORE по (user_id, kind, expires_at)), и
+    напоминание уходит только тем, кого застолбили именно сейчас — поэтому повторный скан,
+    рестарт или второй процесс не пришлют его дважды. Продление даёт новый expires_at,
+    а значит и новое напоминание в следующий раз.
+    """
+
+    def __init__(self, interval: float, window: int, batch: int, rate: float):
+        self.interval = interval
+        self.window = window
+        self.batch = max(1, batch)
+        self.bucket = TokenBucket(rate, rate)
+        self._task: asyncio.Task | None = None
+        self.sent = 0
+        self.failed = 0
+
+    def start(self):
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.scan_once()
+            except Exception:
+                logging.exception("Expiry scan failed")
+            await asyncio.sleep(self.interval)
+
+    async def _claim(self, kind: str, rows: list[tuple[int, int]]) -> list[tuple[int, int]]:
+        async def job(db):
+            claimed = []
+            for user_id, expires_at in rows:
+                cur = await db.execute(
+                    "INSERT OR IGNORE INTO expiry_notices(user_id, kind, expires_at, sent_at) VALUES (?, ?, ?, ?)",
+                    (user_id, kind, expires_at, now_ts())
+                )
+                if cur.rowcount:
+                    claimed.append((user_id, expires_at))
+            return claimed
+        return await db_writer.run(job, op="expiry_claim")
+
+    async def _notify(self, kind: str, user_id: int, expires_at: int):
+        await self.bucket.acquire()
+        try:
+            await bot.send_message(user_id, expiry_notice_text(kind, expires_at), reply_markup=buy_keyboard())
+            self.sent += 1
+        except TelegramForbiddenError:
+            pass  # бот заблокирован — напоминать некому
+        except Exception as e:
+            self.failed += 1
+            logging.warning("Expiry notice (%s) to %s failed: %s", kind, user_id, e)
+
+    async def scan_once(self) -> int:
+        now = now_ts()
+        total = 0
+        for kind, sql in EXPIRY_QUERIES.items():
+            last = (now, 0)
+            while True:
+                async with db_pool.acquire(f"expiry_scan_{kind}") as db:
+                    async with db.execute(sql, (now, now + self.window, *last, self.batch)) as cur:
+                        rows = [tuple(row) for row in await cur.fetchall()]
+                if not rows:
+                    break
+                last = (rows[-1][1], rows[-1][0])
+                claimed = await self._claim(kind, rows)
+                await asyncio.gather(*(self._notify(kind, user_id, expires_at) for user_id, expires_at in claimed))
+                total += len(claimed)
+                if len(rows) < self.batch:
+                    break
+        if total:
+            logging.info("Expiry reminders sent: %s", total)
+        return total
+
+expiry_notifier = ExpiryNotifier(EXPIRY_SCAN_INTERVAL, EXPIRY_NOTICE_WINDOW, EXPIRY_BATCH, EXPIRY_RATE)
+
+# ========= DIALOG ARCHIVE =========
+class DialogArchiver:
+    """Вынос истории неактивных пользователей из БД в сжатые архивы и возврат по требованию.
+
+    Раз в ARCHIVE_INTERVAL сек ищет пользователей, чья последняя реплика старше
+    ARCHIVE_AFTER_DAYS дней (по индексу dialog(user_id, id): последняя реплика — MAX(id)),
+    дописывает их реплики gzip-блоком в личный файл пользователя ARCHIVE_DIR/xx/<user_id>.jsonl.gz
+    и удаляет из dialog. Где лежит блок (файл, смещение, длина), хранится в dialog_archive.
+    Возврат делает get_history_window при промахе кеша — то есть когда пользователь снова
+    написал; после возврата файл удаляется. Файл на пользователя нужен, чтобы «забыть всё»
+    и сброс диалога действительно стирали архив (erase), а не только ссылку на него.
+    Архивация, возврат и стирание одного пользователя идут под dialog_writer.user_lock.
+
+    Освободившиеся страницы отдаются ОС через PRAGMA incremental_vacuum по VACUUM_STEP_PAGES
+    страниц за шаг — каждый шаг короткая транзакция писателя, между ними живой трафик.
+    """
+
+    def __init__(self, directory: str, after_days: int, interval: float, batch: int):
+        self.directory = directory
+        self.after_days = after_days
+        self.interval = interval
+        self.batch = max(1, batch)
+        self._task: asyncio.Task | None = None
+        self.archived_users = 0
+        self.restored_users = 0
+
+    def start(self):
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                if self.after_days > 0:
+                    await self.archive_once()
+                await self.vacuum()
+            except Exception:
+                logging.exception("Dialog archival failed")
+            await asyncio.sleep(self.interval)
+
+    # ---- архивирование
+    async def archive_once(self) -> int:
+        cutoff = (datetime.now() - timedelta(days=self.after_days)).isoformat()
+        total, last_user = 0, -1 << 63
+        while True:
+            async with db_pool.acquire("archive_scan") as db:
+                # последняя реплика каждого пользователя — по индексу, без сканирования всей таблицы
+                async with db.execute("""
+                    SELECT d.user_id, d.ts FROM (
+                        SELECT user_id, MAX(id) AS last_id FROM dialog
+                        WHERE user_id > ? GROUP BY user_id ORDER BY user_id LIMIT ?
+                    ) l JOIN dialog d ON d.id = l.last_id
+                """, (last_user, self.batch)) as cur:
+                    page = await cur.fetchall()
+                inactive = [user_id for user_id, ts in page if ts < cutoff]
+                rows_by_user = {}
+                for user_id in inactive:
+                    async with db.execute(
+                        "SELECT id, role, content, ts FROM dialog WHERE user_id=? ORDER BY id", (user_id,)
+                    ) as cur:
+                        rows_by_user[user_id] = await cur.fetchall()
+            if rows_by_user:
+                await self._archive_users(rows_by_user)
+                total += len(rows_by_user)
+            if len(page) < self.batch:
+                break
+            last_user = page[-1][0]
+        if total:
+            self.archived_users += total
+            logging.info("Dialog archive: moved history of %s inactive user(s) to %s", total, self.directory)
+        return total
+
+    def _path(self, user_id: int) -> str:
+        # подкаталоги, чтобы не держать десятки тысяч файлов в одном каталоге
+        return os.path.join(f"{user_id % 256:02x}", f"{user_id}.jsonl.gz")
+
+    def _write_blocks(self, rows_by_user: dict) -> dict:
+        """Дописывает по gzip-блоку в файл каждого пользователя; возвращает user_id -> (путь, смещение, длина)."""
+        spans = {}
+        for user_id, rows in rows_by_user.items():
+            path = self._path(user_id)
+            full = os.path.join(self.directory, path)
+            os.makedirs(os.path.dirname(full), exist_ok=True)
+            created = not os.path.exists(full)
+            lines = "".join(
+                json.dumps({"id": i, "user_id": user_id, "role": role, "content": content, "ts": ts},
+                           ensure_ascii=False) + "\n"
+                for i, role, content, ts in rows
+            )
+            block = gzip.compress(lines.encode("utf-8"))
+            with open(full, "ab") as f:
+                spans[user_id] = (path, f.tell(), len(block))
+                f.write(block)
+                f.flush()
+                # файл должен быть на диске раньше, чем строки исчезнут из БД
+                os.fsync(f.fileno())
+            if created:
+                dir_fd = os.open(os.path.dirname(full), os.O_RDONLY)
+                try:
+                    os.fsync(dir_fd)
+                finally:
+                    os.close(dir_fd)
+        return spans
+
+    def _drop_blocks(self, spans: dict):
+        """Откатывает дописанные блоки: файл обрезается до прежней длины (или удаляется, если был пуст)."""
+        for path, offset, _ in spans.values():
+            full = os.path.join(self.directory, path)
+            with contextlib.suppress(FileNotFoundError):
+                if offset:
+                    os.truncate(full, offset)
+                else:
+                    os.remove(full)
+
+    async def _archive_users(self, rows_by_user: dict):
+        async with contextlib.AsyncExitStack() as locks:
+            # пока пользователь заблокирован, его не вернут из архива и не сотрут посреди записи
+            for user_id in rows_by_user:
+                await locks.enter_async_context(dialog_writer.user_lock(user_id))
+            spans = await asyncio.to_thread(self._write_blocks, rows_by_user)
+
+            async def job(db):
+                gone = []
+                for user_id, rows in rows_by_user.items():
+                    # только заархивированные строки: реплика, дописанная за это время, останется в dialog
+                    cur = await db.execute("DELETE FROM dialog WHERE user_id=? AND id<=?", (user_id, rows[-1][0]))
+                    if not cur.rowcount:
+                        # историю уже стёрли (сброс или «забыть всё») — блок сохранять нельзя
+                        gone.append(user_id)
+                        continue
+                    path, offset, length = spans[user_id]
+                    # запись уже есть, если прошлый restore не удался: новый блок лёг в тот же файл сразу
+                    # за старым, поэтому запись растягивается на оба (gzip читает склеенные блоки подряд)
+                    await db.execute("""
+                        INSERT INTO dialog_archive(user_id, path, offset, length, rows, archived_at)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                        ON CONFLICT(user_id) DO UPDATE SET
+                            length = excluded.offset + excluded.length - dialog_archive.offset,
+                            rows = dialog_archive.rows + excluded.rows,
+                            archived_at = excluded.archived_at
+                    """, (user_id, path, offset, length, len(rows), now_ts()))
+                return gone
+            try:
+                gone = await db_writer.run(job, op="archive_users")
+            except BaseException:
+                await asyncio.to_thread(self._drop_blocks, spans)
+                raise
+            if gone:
+                await asyncio.to_thread(self._drop_blocks, {user_id: spans[user_id] for user_id in gone})
+            for user_id in rows_by_user:
+                history_cache.drop(user_id)
+
+    async def erase(self, user_id: int):
+        """Удаляет архивный файл пользователя; вызывать под user_lock после удаления записи dialog_archive."""
+        def remove():
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(self.directory, self._path(user_id)))
+        await asyncio.to_thread(remove)
+
+    # ---- возврат
+    def _read_block(self, name: str, offset: int, length: int) -> list[dict]:
+        with open(os.path.join(self.directory, name), "rb") as f:
+            f.seek(offset)
+            block = f.read(length)
+        return [json.loads(line) for line in gzip.decompress(block).decode("utf-8").splitlines() if line]
+
+    async def restore(self, user_id: int) -> int:
+        """Возвращает архивную историю пользователя в dialog; вызывать под dialog_writer.user_lock(user_id)."""
+        async with db_pool.acquire("archive_lookup") as db:
+            async with db.execute(
+                "SELECT path, offset, length FROM dialog_archive WHERE user_id=?", (user_id,)
+            ) as cur:
+                row = await cur.fetchone()
+        if row is None:
+            return 0
+        try:
+            entries = await asyncio.to_thread(self._read_block, *row)
+        except Exception:
+            # без старой истории ответить всё равно можно; запись оставляем для ручного разбора,
+            # следующая архивация допишет новый блок к ней же
+            logging.exception("Dialog archive: failed to restore user %s from %s", user_id, row[0])
+            return 0
+
+        async def job(db):
+            # исходные id: AUTOINCREMENT их не переиспользует, порядок истории сохраняется
+            await db.executemany(
+                "INSERT OR IGNORE INTO dialog (id, user_id, role, content, ts) VALUES (?, ?, ?, ?, ?)",
+                [(e["id"], user_id, e["role"], e["content"], e["ts"]) for e in entries]
+            )
+            await db.execute("DELETE FROM dialog_archive WHERE user_id=?", (user_id,))
+        await db_writer.run(job, op="archive_restore")
+        # история снова в БД — архивная копия больше не нужна
+        await self.erase(user_id)
+        self.restored_users += 1
+        logging.info("Dialog archive: restored %s message(s) for user %s", len(entries), user_id)
+        return len(entries)
+
+    # ---- возврат места
+    async def vacuum(self) -> int:
+        """Отдаёт свободные страницы файла ОС маленькими шагами; возвращает число освобождённых."""
+        freed = 0
+        while True:
+            async def job(db):
+                async with db.execute("PRAGMA freelist_count") as cur:
+                    before = (await cur.fetchone())[0]
+                if before:
+                    # модуль sqlite3 останавливает incremental_vacuum(N) после первой страницы
+                    # (строки результата без колонок), а executemany доводит каждый вызов до конца;
+                    # курсор закрываем сразу: незавершённое выражение держит снимок WAL и мешает checkpoint
+                    async with db.executemany("PRAGMA incremental_vacuum(1)", [()] * min(before, VACUUM_STEP_PAGES)):
+                        pass
+                async with db.execute("PRAGMA freelist_count") as cur:
+                    return before - (await cur.fetchone())[0]
+            step = await db_writer.run(job, op="incremental_vacuum")
+            freed += step
+            if step < VACUUM_STEP_PAGES:
+                break
+            await asyncio.sleep(VACUUM_STEP_PAUSE)
+        if freed:
+            logging.info("Incremental vacuum: released %s page(s)", freed)
+            # освобождённые страницы прошли через WAL — обрезаем его, вне транзакции писателя
+            async with db_pool.acquire("wal_checkpoint") as db:
+                await wal_checkpoint(db)
+        return freed
+
+dialog_archiver = DialogArchiver(ARCHIVE_DIR, ARCHIVE_AFTER_DAYS, ARCHIVE_INTERVAL, ARCHIVE_BATCH)
 
 # ========= RUN =========
 async def main():
     await init_db()
-    await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    await start_http_client()
+    await resume_broadcasts()
+    expiry_notifier.start()
+    dialog_archiver.start()
+    try:
+        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    finally:
+        await dialog_archiver.stop()
+        await expiry_notifier.stop()
+        await stop_broadcasts()
+        await wait_pending_turns(10)
+        await close_http_client()
+        await close_db()
 
 if __name__ == "__main__":
     try:
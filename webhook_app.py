@@ -1,27 +1,316 @@
 import os
+import time
+import asyncio
 import logging
+from collections import deque
+
+# время импорта тоже часть холодного старта: большую часть занимает сборка pydantic-моделей aiogram
+_IMPORT_STARTED = time.perf_counter()
+
 from fastapi import FastAPI, Request, Response
-from aiogram.types import Update
+from aiogram.types import Update, User
+from pydantic import ValidationError
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Gauge, generate_latest, multiprocess
+
+from main import (  # твой текущий main.py
+    bot, dp, init_db, close_db, start_http_client, close_http_client, wait_pending_turns,
+    llm_scheduler, LLM_USAGE, cache_hit_ratio, providers_stats, history_cache,
+    resume_broadcasts, stop_broadcasts, expiry_notifier, dialog_archiver,
+    get_meta, set_meta,
+)
 
-from main import bot, dp, init_db  # твой текущий main.py
+IMPORT_SECONDS = time.perf_counter() - _IMPORT_STARTED
 
 app = FastAPI()
 
 WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "supersecret")
 PUBLIC_URL = os.getenv("PUBLIC_URL")  # можно не задавать
 
-@app.on_event("startup")
-async def on_startup():
-    await init_db()
+# Очередь апдейтов: вебхук только кладёт апдейт и сразу отвечает Telegram 200,
+# обработку (вместе с походом в DeepSeek) делают фоновые задачи — по одной на чат
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))          # апдейтов в очереди и в обработке
+WEBHOOK_ENQUEUE_TIMEOUT = float(os.getenv("WEBHOOK_ENQUEUE_TIMEOUT", "2"))  # сек ждать места, потом 503
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "10"))     # сек дообработки при остановке
+
+# Несколько воркеров (uvicorn --workers): у каждого свой реестр метрик, и /metrics отдал бы числа
+# случайного воркера. С PROMETHEUS_MULTIPROC_DIR (пустой каталог, задать до старта и чистить при
+# деплое) воркеры пишут метрики в файлы, а /metrics суммирует их
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+# Быстрый старт (бесплатный Render усыпляет инстанс, и холодный старт ложится на первого пользователя):
+# сетевые вызовы идут параллельно, get_me берётся из кеша в БД, setWebhook только если адрес изменился,
+# а рассылки, напоминания и архив запускаются после первого запроса
+FAST_START = os.getenv("FAST_START", "1") == "1"
+DEFERRED_INIT_DELAY = float(os.getenv("DEFERRED_INIT_DELAY", "5"))  # сек после первого запроса
+
+
+def update_key(data: dict) -> int:
+    """Ключ упорядочивания: чат апдейта (или отправитель), иначе update_id."""
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat and "id" in chat:
+            return chat["id"]
+        sender = value.get("from")
+        if sender and "id" in sender:
+            return sender["id"]
+    return data.get("update_id", 0)
+
+
+class UpdateQueue:
+    """Ограниченная очередь апдейтов с обработкой по чатам.
+
+    У каждого чата (update_key) своя очередь и своя задача: сообщения одного чата
+    обрабатываются строго по порядку, разные чаты параллельно, а ожидание флуд-контроля
+    (лимит чата, пауза по RetryAfter) задерживает только свой чат. Всего в очереди и в
+    обработке не больше maxsize апдейтов; если места нет, put ждёт WEBHOOK_ENQUEUE_TIMEOUT
+    и сдаётся — вебхук отвечает 503, и Telegram повторит доставку позже.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = max(1, maxsize)
+        self._slots = asyncio.Semaphore(self.maxsize)
+        self._chats: dict[int, deque] = {}
+        self._tasks: dict[int, asyncio.Task] = {}
+        self._queued = 0
+        self.enqueued = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    async def stop(self, timeout: float):
+        deadline = time.monotonic() + timeout
+        # пока дообрабатываем, могут появиться новые чаты — ждём, пока не опустеет или не выйдет время
+        while self._tasks and time.monotonic() < deadline:
+            await asyncio.wait(list(self._tasks.values()), timeout=deadline - time.monotonic())
+        if self._tasks:
+            logging.warning("Update queue: %s update(s) dropped on shutdown", self.depth)
+            tasks = list(self._tasks.values())
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def put(self, key: int, update: Update) -> bool:
+        try:
+            await asyncio.wait_for(self._slots.acquire(), WEBHOOK_ENQUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            return False
+        self._chats.setdefault(key, deque()).append((time.monotonic(), update))
+        self._queued += 1
+        self.enqueued += 1
+        WEBHOOK_QUEUE_DEPTH.set(self._queued)
+        if key not in self._tasks:
+            self._tasks[key] = asyncio.create_task(self._drain(key))
+        return True
+
+    async def _drain(self, key: int):
+        queue = self._chats[key]
+        try:
+            while queue:
+                enqueued_at, update = queue.popleft()
+                self._queued -= 1
+                WEBHOOK_QUEUE_DEPTH.set(self._queued)
+                wait = time.monotonic() - enqueued_at
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+                try:
+                    await dp.feed_update(bot, update)
+                    self.processed += 1
+                except Exception:
+                    self.failed += 1
+                    logging.exception("Update %s failed", update.update_id)
+                finally:
+                    self._slots.release()
+        finally:
+            # между последней проверкой очереди и удалением нет await — put не потеряет апдейт
+            self._queued -= len(queue)
+            del self._chats[key]
+            del self._tasks[key]
+
+    @property
+    def depth(self) -> int:
+        return self._queued
+
+    def stats(self) -> dict:
+        done = self.processed + self.failed
+        return {
+            "depth": self.depth,
+            "capacity": self.maxsize,
+            "chats": len(self._tasks),
+            "enqueued": self.enqueued,
+            "rejected": self.rejected,
+            "processed": self.processed,
+            "failed": self.failed,
+            "wait_avg_ms": round(self.wait_total / done * 1000, 1) if done else 0.0,
+            "wait_max_ms": round(self.wait_max * 1000, 1),
+        }
+
+
+update_queue = UpdateQueue(WEBHOOK_QUEUE_SIZE)
+# значение обновляется на put/get, а не в момент скрейпа: set_function не работает в multiprocess-режиме
+WEBHOOK_QUEUE_DEPTH = Gauge("sophia_webhook_queue_depth", "Updates waiting in the webhook queue",
+                            multiprocess_mode="livesum")
+
+class StartupTimer:
+    """Замеры фаз старта: пишет в лог одну строку с разбивкой по фазам."""
+
+    def __init__(self):
+        self.phases: dict[str, float] = {}
+        self._t0 = time.perf_counter()
+
+    async def run(self, name: str, coro):
+        t0 = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            self.phases[name] = round((time.perf_counter() - t0) * 1000, 1)
+
+    def log(self, title: str):
+        total = round((time.perf_counter() - self._t0) * 1000, 1)
+        breakdown = ", ".join(f"{name}={ms:.0f}" for name, ms in self.phases.items())
+        logging.info("%s in %.0f ms (%s)", title, total, breakdown)
+        self.phases["total"] = total
+
+
+STARTUP_TIMINGS: dict[str, dict] = {}
+_background: set[asyncio.Task] = set()
+_deferred_task: asyncio.Task | None = None
+_refresh_me_deferred = False  # get_me взят из кеша — обновим его в фоне
+
+
+def _spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+    return task
+
+
+async def cached_me() -> tuple[User, bool]:
+    """Профиль бота из кеша в БД; за сетью идём только на первом старте (или при смене токена)."""
+    raw = await get_meta("get_me")
+    if raw:
+        me = User.model_validate_json(raw)
+        if me.id == bot.id:
+            return me, True
+    return await refresh_me(), False
+
+
+async def refresh_me() -> User:
     me = await bot.get_me()
-    logging.info("RUNNING AS @%s (id=%s)", me.username, me.id)
+    await set_meta("get_me", me.model_dump_json(exclude_none=True))
+    return me
+
+
+async def ensure_webhook():
     # Вебхук можно ставить вручную через setWebhook, поэтому PUBLIC_URL не обязателен
-    if PUBLIC_URL:
-        await bot.set_webhook(f"{PUBLIC_URL}/webhook/{WEBHOOK_SECRET}")
+    if not PUBLIC_URL:
+        return
+    url = f"{PUBLIC_URL}/webhook/{WEBHOOK_SECRET}"
+    info = await bot.get_webhook_info()
+    if info.url == url:
+        logging.info("Webhook is already set, setWebhook skipped")
+        return
+    await bot.set_webhook(url)
+
+
+async def deferred_init(delay: float = 0.0):
+    """Некритичная инициализация: фоновые задачи, которые не нужны для ответа первому пользователю."""
+    if delay:
+        await asyncio.sleep(delay)
+    timer = StartupTimer()
+    await timer.run("broadcasts", resume_broadcasts())
+    expiry_notifier.start()
+    dialog_archiver.start()
+    if _refresh_me_deferred:
+        try:
+            await timer.run("get_me_refresh", refresh_me())
+        except Exception as e:
+            logging.warning("get_me refresh failed: %s", e)
+    timer.log("Deferred init done")
+    STARTUP_TIMINGS["deferred_ms"] = timer.phases
+
+
+def schedule_deferred_init():
+    global _deferred_task
+    if _deferred_task is None:
+        _deferred_task = _spawn(deferred_init(DEFERRED_INIT_DELAY))
+
+
+@app.middleware("http")
+async def first_request_trigger(request: Request, call_next):
+    # первый запрос (вебхук или health-check) означает, что инстанс проснулся и отвечает
+    if FAST_START:
+        schedule_deferred_init()
+    return await call_next(request)
+
+
+@app.on_event("startup")
+async def on_startup():
+    global _refresh_me_deferred
+    timer = StartupTimer()
+    await timer.run("db", init_db())
+    if FAST_START:
+        # прогрев DeepSeek не блокирует старт: соединение нужно к первому ответу модели, а не к приёму вебхука
+        _spawn(start_http_client())
+        (me, cached), _ = await asyncio.gather(
+            timer.run("get_me", cached_me()),
+            timer.run("webhook", ensure_webhook()),
+        )
+        _refresh_me_deferred = cached
+    else:
+        await timer.run("http_client", start_http_client())
+        await timer.run("deferred", deferred_init())
+        me = await timer.run("get_me", refresh_me())
+        cached = False
+        await timer.run("webhook", ensure_webhook())
+    logging.info("RUNNING AS @%s (id=%s)%s", me.username, me.id, " [cached]" if cached else "")
+    timer.log(f"Startup done ({'fast start, ' if FAST_START else ''}imports {IMPORT_SECONDS * 1000:.0f} ms)")
+    STARTUP_TIMINGS["import_ms"] = round(IMPORT_SECONDS * 1000, 1)
+    STARTUP_TIMINGS["startup_ms"] = timer.phases
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    global _deferred_task
+    await update_queue.stop(WEBHOOK_DRAIN_TIMEOUT)
+    # отложенная инициализация могла не успеть начаться — остановки ниже безопасны и без старта
+    for task in list(_background):
+        task.cancel()
+    await asyncio.gather(*_background, return_exceptions=True)
+    _deferred_task = None
+    await dialog_archiver.stop()
+    await expiry_notifier.stop()
+    await stop_broadcasts()
+    await wait_pending_turns(WEBHOOK_DRAIN_TIMEOUT)
+    await close_http_client()
+    await close_db()
+    await bot.session.close()
+    if PROMETHEUS_MULTIPROC_DIR:
+        # livesum-гейджи остановленного воркера больше не суммируются
+        multiprocess.mark_process_dead(os.getpid())
 
 @app.get("/health")
 async def health():
-    return {"ok": True}
+    return {
+        "ok": True,
+        "queue": update_queue.stats(),
+        "llm": llm_scheduler.stats(),
+        "llm_usage": {**LLM_USAGE, "cache_hit_ratio": round(cache_hit_ratio(), 3)},
+        "llm_providers": providers_stats(),
+        "history_cache": history_cache.stats(),
+        "startup": STARTUP_TIMINGS,
+    }
+
+@app.get("/metrics")
+async def metrics():
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 @app.post("/webhook/{secret}")
 async def telegram_webhook(secret: str, request: Request):
@@ -39,7 +328,14 @@ async def telegram_webhook(secret: str, request: Request):
     except Exception as e:
         logging.exception("Direct send from webhook failed: %s", e)
 
-    # Обычная передача апдейта в aiogram
-    update = Update.model_validate(data)
-    await dp.feed_update(bot, update)
+    # Проверяем апдейт и ставим в очередь; ответ Telegram не ждёт обработки
+    try:
+        update = Update.model_validate(data, context={"bot": bot})
+    except ValidationError as e:
+        # повтор от Telegram не поможет — подтверждаем и пропускаем
+        logging.warning("Invalid update skipped: %s", e)
+        return {"ok": True}
+    if not await update_queue.put(update_key(data), update):
+        logging.warning("Update queue is full, asking Telegram to retry update %s", update.update_id)
+        return Response(status_code=503)
     return {"ok": True}